@@ -0,0 +1,172 @@
+"""
+Times every stage of the payroll pipeline on synthetic schedules (see schedule_generator.py):
+
+    python benchmark.py --sizes 40 400 4000
+    python benchmark.py --sizes 40 --compare benchmark_results/<previous run>.json
+
+Stages are parse (ShiftStream over every file, shifts, hourly rates and building name), transform (compact_shifts
+of every batch, typed columns, calendar columns + hours_worked), ingest (the parallel ingest_workbooks path the app
+uses), cube (IncrementalCube of every file), cube_replace_one (the cube after one file is submitted again),
+hours_worked, process_hours, process_hours_version_2, pay (payroll_by_building) and export (every report in every
+available format, see report_export.py). Results are saved as json in benchmark_results/
+with the git commit they were measured on, so runs of two commits can be compared with --compare.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+import helper_functions as x
+from payroll_cube import IncrementalCube
+from report_export import export_report
+from schedule_generator import generate_pay_period, period_name
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results")
+
+
+@contextmanager
+def timer(timings, stage, repeat_times):
+    """ Adds the wall time of the block to timings[stage], keeping the fastest of the repeats """
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    repeat_times.setdefault(stage, []).append(elapsed)
+    timings[stage] = min(repeat_times[stage])
+
+
+def prepare_files(data_dir, count, employees):
+    """ Generates the schedules once and reuses them on the next runs """
+    paths = [os.path.join(data_dir, "schedule_{:04d}.xlsx".format(number + 1)) for number in range(count)]
+    if not all(os.path.exists(path) for path in paths):
+        print("Generating {} workbooks in {}".format(count, data_dir))
+        paths = generate_pay_period(data_dir, buildings=count, employees=employees, weeks=2)
+    return paths
+
+
+def run_stages(files, sheet_name, workers, repeat):
+    """ Runs the pipeline stage by stage on the files, returns {stage: seconds} and the number of shifts """
+    timings = {}
+    repeat_times = {}
+    for _ in range(repeat):
+        with timer(timings, "parse", repeat_times):
+            batches = []
+            hourly_rates_list = []
+            for file in files:
+                workbook = x._open_workbook(file)
+                try:
+                    stream = x.ShiftStream(x._worksheet(workbook, sheet_name).iter_rows(values_only=True), sheet_name, file_name=file)
+                    batches.extend(stream)
+                    hourly_rates_list.append(stream.hourly_rates())
+                finally:
+                    workbook.close()
+            hourly_rates_df = pd.concat(hourly_rates_list, axis=0)
+
+        #the same steps _ingest_workbook runs on each batch, in this process
+        with timer(timings, "transform", repeat_times):
+            df = x.concat_shifts([x.compact_shifts(batch, x.HOLIDAYS) for batch in batches])
+        shifts = pd.concat(batches, axis=0, ignore_index=True)
+        del batches
+
+        with timer(timings, "ingest", repeat_times):
+            results = list(x.ingest_workbooks(files, sheet_name, max_workers=workers))
+
+        with timer(timings, "cube", repeat_times):
+            incremental_cube = IncrementalCube()
+            incremental_cube.update(results)
+
+        #one file corrected and submitted again: same shifts under a new key, only its employee-weeks are recalculated
+        with timer(timings, "cube_replace_one", repeat_times):
+            incremental_cube.update(results[1:] + [dict(results[0], key=results[0]['key'] + ":replaced")])
+        del results, incremental_cube
+
+        with timer(timings, "hours_worked", repeat_times):
+            x.hours_worked(shifts.copy())
+
+        with timer(timings, "process_hours", repeat_times):
+            x.process_hours(df.copy())
+
+        with timer(timings, "process_hours_version_2", repeat_times):
+            x.process_hours_version_2(df.copy())
+
+        with timer(timings, "pay", repeat_times):
+            payroll_df = x.payroll_by_building(df.copy(), hourly_rates_df)
+
+        with timer(timings, "export", repeat_times):
+            employee_hours_df = x.employee_hours_summary(df.copy(), show_names=False)
+            shown_hours_df = employee_hours_df.assign(**{'Employee Name': x.find_employee_names(employee_hours_df)})
+            frames = {"employee_hours": shown_hours_df, "paychex": employee_hours_df, "payroll_by_building": payroll_df, "shifts": df}
+            for report, frame in frames.items():
+                export_report(report, frame, hourly_rates=hourly_rates_df)
+
+    return timings, len(shifts)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, previous_path):
+    """ Prints the time of every stage next to the one measured in a previous run """
+    with open(previous_path) as file:
+        previous = json.load(file)
+    print("\nCompared to {} (commit {})".format(previous_path, previous.get("commit")))
+    for size, timings in results["sizes"].items():
+        old = previous["sizes"].get(size)
+        if old is None:
+            continue
+        for stage, seconds in timings["stages"].items():
+            if stage in old["stages"] and old["stages"][stage] > 0:
+                print("{:>6} files  {:<25} {:>9.3f}s  was {:>9.3f}s  ({:.2f}x)".format(
+                    size, stage, seconds, old["stages"][stage], old["stages"][stage] / seconds if seconds else float("inf")))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Times every stage of the payroll pipeline on synthetic schedules")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[40, 400, 4000], help="number of files of each run (default: 40 400 4000)")
+    parser.add_argument("--employees", type=int, default=25, help="employees per building (default: 25)")
+    parser.add_argument("--workers", type=int, default=None, help="processes used by the ingest stage (default: one per CPU core)")
+    parser.add_argument("--repeat", type=int, default=1, help="repeat every size and keep the fastest time (default: 1)")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "payroll-benchmark"), help="where the generated workbooks are kept")
+    parser.add_argument("--output", default=None, help="json file to save the results to (default: benchmark_results/<date>-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="json file of a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    files = prepare_files(args.data_dir, max(args.sizes), args.employees)
+    sheet_name = period_name(datetime(2023, 1, 16))
+
+    commit = git_commit()
+    results = {"commit": commit, "date": datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(), "pandas": pd.__version__,
+               "employees_per_building": args.employees, "sizes": {}}
+
+    for size in args.sizes:
+        timings, shifts = run_stages(files[:size], sheet_name, args.workers, args.repeat)
+        results["sizes"][str(size)] = {"shifts": shifts, "stages": timings, "total": sum(timings.values())}
+        print("\n{} files, {} shifts".format(size, shifts))
+        for stage, seconds in timings.items():
+            print("  {:<25} {:>9.3f}s".format(stage, seconds))
+
+    output = args.output or os.path.join(RESULTS_DIR, "{}-{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S"), commit))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print("\nSaved results to {}".format(output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
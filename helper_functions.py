@@ -1,69 +1,227 @@
 import pandas as pd
 import numpy as np
 import re
+import io
+import os
+import hashlib
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta, time
+from openpyxl import load_workbook
+from pipeline_trace import PipelineTrace, NULL_TRACE
+from payroll_engine import PayrollCostEngine, summarize_payroll
+from pay_rules import PayRules
 
-def transform_schedule(file_name, sheet_name):
-    """ This function transforms the user input schedule into a format that can be further analyzed
-    
-    parameters: 
-    file_name: excel or xlsx file format
+#memory budget of the parsed workbook cache, can be changed with the PAYROLL_CACHE_MB environment variable
+CACHE_MAX_BYTES = int(os.environ.get("PAYROLL_CACHE_MB", "256")) * 1024 * 1024
+
+#tabs named like "1-16 to 1-29" hold the schedule of one bi-weekly pay period
+PERIOD_TAB_PATTERN = r"^\s*\d{1,2}-\d{1,2}\s*to\s*\d{1,2}-\d{1,2}\s*$"
+
+#number of shifts the streaming extractor hands over at a time
+SHIFT_BATCH_SIZE = 5000
+
+#building of the shifts of a tab whose title has no building name in it, one per file so their hours are not mixed
+UNKNOWN_BUILDING = "Unknown building ({})"
+
+#rows whose name or hourly rate cell contains one of these words are headers or totals, not employees
+RATE_ROW_EXCLUDE = "Employees|Day|Employee|Date|total hours"
+
+# List of holiday dates provided by Matt
+HOLIDAYS = ['2023-11-23', '2023-11-25', '2023-12-31', '2023-07-04', '2023-05-29', '2023-09-04']
+
+class ShiftStream:
+    """ Walks the rows of one schedule tab once and yields its shifts in batches, without keeping the sheet in memory
+
+    Every employee row is handled as it is read: each time in (a column under a date) is paired with the time out
+    in the column next to it. The building name and hourly rates are collected on the way and can be read once
+    the stream has been consumed. building_name stays None when the title has no building name in it, the shifts
+    then get UNKNOWN_BUILDING so they still count.
+
+    parameters:
+    rows: iterator over the rows of the tab as tuples of values, for ex. worksheet.iter_rows(values_only=True)
     sheet_name: name of the sheet as in excel file
+    file_name: name of the file the rows come from, used in error messages
+    batch_size: maximum number of shifts in each dataframe that is yielded
 
-    returns:
-    A dataframe that contains four columns, employee name, date, hour in, hour out
+    yields:
+    dataframes with employee name, date, time in, time out and building name, one row per shift of week one and week two
 
     """
-    #read excel file
-    df = pd.read_excel(file_name, sheet_name= sheet_name)
-
-    #remove first row which usually contains the name of the building for ex. hamilton cove
-    df = df.iloc[1:]
-
-    #replace null values with a string called unknown, this will help us down the road
-    df= df.replace(np.NaN, "Unknown").reset_index(drop=True).iloc[:,1:].reset_index(drop=True)
-
-    #find the index of the first week, from here you will determine where the first week starts 
-    index_of_first_week = df[df['Unnamed: 1'].str.contains("Date") == True].index[0]
-    index_of_second_week = df[df['Unnamed: 1'].str.contains("Date") == True].index[1]
-
-    #rename columns of the dataframe to match that the row of where the first week starts, the columns are now dates that start from 1/16 to 1/22 (first week only)
-    df.columns = df.iloc[index_of_first_week]
-    df = df.iloc[:index_of_second_week, : ]
-
-    #lets drop any unknown value in the Date column, if there are no employees why keep it?
-    #The date column is just called DATE but in reality that column contains names of each employee
-    df = df[df['Date'] !="Unknown"].reset_index(drop =True)
-    df = df[df['Date'] !="Name of Employee"].reset_index(drop =True)
-    df = df[df['Date'] !="Date"].reset_index(drop =True)
-    
-    #unpivot the date while fixing the name of the employee
-    melt_df = pd.melt(df, id_vars="Date")
-    
-    #clean up the melt dataframe by removing any employee without work hours, and remove any text like the word "day"
-    melt_df = melt_df[melt_df['value'] !="Unknown"].reset_index(drop =True)
-    melt_df = melt_df[melt_df['Date'] !="Day"].reset_index(drop =True)
-
-    #some rows that contain total hours get pulled in, but we only need the time worked, our strategy to keep only hourly date was to focus on strings with the : format
-    melt_df['value'] = melt_df['value'].astype("str")
-    melt_df = melt_df[melt_df['value'].str.contains(":")]
-
-    #rename some of the columns
-    melt_df = melt_df.rename(columns={"Date":"Employee Name", "value":"Hours"})
-    melt_df.columns.values[1] = "Date"
-
-    #we found an interesting pattern, if the Date had an unknown string, that meant that the this is the time out, but if they had a time instead, that meant time in. 
-    # so we split the data into test_df1 and test_df2 that we could then merge
-    df1 = melt_df[melt_df['Date'] != "Unknown"].reset_index(drop=True)
-    df1 = df1.rename(columns={"Hours":"Time In"})
-    
-    df2 = melt_df[melt_df['Date'] == "Unknown"].reset_index(drop=True)
-    df2 = df2.rename(columns={"Hours":"Time Out"})
-    df2 = df2[["Time Out"]]
-    
-    merged_df = pd.merge(left=df1, right=df2, left_index=True, right_index=True)
-
-    return merged_df
+
+    def __init__(self, rows, sheet_name, file_name=None, batch_size=SHIFT_BATCH_SIZE):
+        self.rows = rows
+        self.sheet_name = sheet_name
+        self.file_name = file_name
+        self.batch_size = batch_size
+        self.building_name = None
+        self.shift_count = 0
+        self._names = []
+        self._rates = []
+
+    def __iter__(self):
+        headers = []
+        rows_before_first_week = []
+        batch = []
+        for row_number, row in enumerate(self.rows):
+            #pd.read_excel uses the first row as the header, so it never held any data
+            if row_number == 0:
+                continue
+            self._collect_rate(row)
+
+            #the next row usually contains the name of the building for ex. hamilton cove
+            if row_number == 1:
+                self.building_name = _building_name_from_title(_cell(row, 1))
+                continue
+
+            #the first two rows with "Date" in the name column hold the dates of week one and week two
+            name = _cell(row, 1)
+            if isinstance(name, str) and "Date" in name and len(headers) < 2:
+                headers.append(_WeekHeader(row))
+                if len(headers) == 1:
+                    for pending_row in rows_before_first_week:
+                        batch.extend(headers[0].shifts(pending_row))
+                    rows_before_first_week = []
+
+            if not headers:
+                rows_before_first_week.append(row)
+                continue
+
+            batch.extend(headers[-1].shifts(row))
+            if len(batch) >= self.batch_size:
+                yield self._frame(batch)
+                batch = []
+
+        if len(headers) < 2:
+            raise ValueError("Could not find the two 'Date' header rows in sheet '{}' of {}".format(self.sheet_name, self.file_name))
+
+        #consumers always get at least one dataframe, even for a tab without shifts
+        if batch or self.shift_count == 0:
+            yield self._frame(batch)
+
+    def _frame(self, batch):
+        self.shift_count += len(batch)
+        df = pd.DataFrame(batch, columns=['Employee Name', 'Date', 'Time In', 'Time Out'])
+        df['Building Name'] = self.building_name or UNKNOWN_BUILDING.format(self.file_name or self.sheet_name)
+        return df
+
+    def _collect_rate(self, row):
+        """ Keeps the name (column 1) and hourly rate (column 17) of rows that are not headers or totals """
+        name = _cell(row, 1)
+        rate = _cell(row, 17)
+        if _matches(RATE_ROW_EXCLUDE, name) or _matches(RATE_ROW_EXCLUDE, rate):
+            return
+        if name is not None:
+            self._names.append(name)
+        if rate is not None:
+            self._rates.append(rate)
+
+    def hourly_rates(self):
+        """ Returns the average hourly rate of each employee, indexed by employee name (once the stream has been consumed) """
+        return _hourly_rates_from_columns(self._rates, self._names)
+
+
+class _WeekHeader:
+    """ The "Date" row of one week, tells which columns hold a time in (under a date) and which a time out (no header) """
+
+    def __init__(self, row):
+        labels = [_cell(row, column) for column in range(len(row))]
+        #the name column is called Date in the schedules
+        self.name_column = next((column for column in range(1, len(labels)) if labels[column] == "Date"), 1)
+        self.labels = labels
+
+    def shifts(self, row):
+        """ (employee name, date, time in, time out) of every shift on one row """
+        name = _cell(row, self.name_column)
+        if name is None or name in ("Unknown", "Name of Employee", "Date", "Day"):
+            return []
+
+        times_in = []
+        times_out = []
+        for column in range(1, len(row)):
+            value = _cell(row, column)
+            if column == self.name_column or value is None:
+                continue
+            #only cells in the HH:MM:SS format are hours, this skips totals and text
+            value = str(value)
+            if ":" not in value:
+                continue
+            label = self.labels[column] if column < len(self.labels) else None
+            if label is None:
+                times_out.append(value)
+            else:
+                times_in.append((label, value))
+
+        return [(name, date, time_in, time_out) for (date, time_in), time_out in zip(times_in, times_out)]
+
+
+def _cell(row, column):
+    """ Value of a cell, None when it is empty or past the end of the row """
+    if column >= len(row):
+        return None
+    value = row[column]
+    return None if value == "" else value
+
+
+def _matches(pattern, value):
+    return value is not None and re.search(pattern, str(value)) is not None
+
+
+def _hourly_rates_from_columns(r_column, b_column):
+    """ Pairs the hourly rates with the employee names, then averages the rates of each employee """
+    #create a new dataframe and name it hourly rates df, transpose it and rename the columns to human readable values
+    hourly_rates_df = pd.DataFrame([r_column, b_column]).T.rename(columns={0:"Hourly Rate", 1:"Employee Name"})
+    #change data type of hourly rate into float
+    hourly_rates_df['Hourly Rate'] = hourly_rates_df['Hourly Rate'].astype("float")
+    #group by employee name and get the average of hourly rate
+    hourly_rates_df = hourly_rates_df.groupby("Employee Name").agg({"Hourly Rate":"mean"}).reset_index()
+    #set the employee name to be the index
+    hourly_rates_df = hourly_rates_df.set_index("Employee Name")
+
+    return hourly_rates_df.fillna(17)
+
+
+def _building_name_from_title(text):
+    """ Uses Regex to extract the name of the building from the title, for ex. "Hamilton Cove Employees Weekly Schedule" """
+    if not isinstance(text, str):
+        return None
+    match = re.search(r'^([\w\s]+)\s(Weekly|employees)', text, re.IGNORECASE)
+    if match:
+        return match.group(1)
+    return None
+
+
+def _open_workbook(file_name):
+    """ Opens an excel file in read-only, values only mode, the sheets are read lazily """
+    #uploaded files may have been read before, always start from the beginning
+    if hasattr(file_name, "seek"):
+        file_name.seek(0)
+    return load_workbook(file_name, read_only=True, data_only=True, keep_links=False)
+
+
+def _select_tabs(workbook, sheet_names, pattern, label):
+    """ The tabs to read, every tab matching pattern when sheet_names is None """
+    if sheet_names is not None:
+        return sheet_names
+    sheet_names = find_period_tabs(workbook.sheetnames, pattern)
+    if not sheet_names:
+        raise ValueError("None of the tabs of {} look like a pay period ({})".format(label, ", ".join(workbook.sheetnames)))
+    return sheet_names
+
+
+def _worksheet(workbook, sheet_name):
+    worksheet = workbook[sheet_name] if isinstance(sheet_name, str) else workbook.worksheets[sheet_name]
+    #read-only sheets can carry wrong dimensions, so let openpyxl figure them out while reading
+    worksheet.reset_dimensions()
+    return worksheet
+
+
+def find_period_tabs(sheet_names, pattern=PERIOD_TAB_PATTERN):
+    """ Names of the tabs that look like a pay period, for ex. "1-16 to 1-29", in the order they appear """
+    return [name for name in sheet_names if re.match(pattern, name, re.IGNORECASE)]
 
 
 def hours_worked(merged_test_df):
@@ -76,233 +234,535 @@ def hours_worked(merged_test_df):
     """
 
 
+    #compact shifts (see compact_shifts) already hold time in and out as minutes since midnight
+    if pd.api.types.is_integer_dtype(merged_test_df['Time In']):
+        minutes = merged_test_df['Time Out'].astype("int32") - merged_test_df['Time In'].astype("int32")
+        #a shift that ends at or before it starts ends the next day
+        minutes = minutes.where(minutes > 0, minutes + 24 * 60)
+        merged_test_df['Hours Worked'] = (minutes / 60).astype("float32")
+        return merged_test_df
+
     #make sure that time in and out are in datetime formats
     merged_test_df['Time In'] = pd.to_datetime(merged_test_df['Time In'], format='%H:%M:%S')
     merged_test_df['Time Out'] = pd.to_datetime(merged_test_df['Time Out'], format='%H:%M:%S')
 
-    #calculate the number of hours worked between time in and time out
-    merged_test_df['Hours Worked'] = merged_test_df['Time Out'] - merged_test_df['Time In']
-    merged_test_df['Hours Worked'] = merged_test_df['Hours Worked'].apply(lambda x: x.total_seconds() / 3600 if x.total_seconds() > 0 else (x + pd.Timedelta('1D')).total_seconds() / 3600)
+    #calculate the number of hours worked between time in and time out, a shift that ends at or before it starts ends the next day
+    hours = (merged_test_df['Time Out'] - merged_test_df['Time In']).dt.total_seconds() / 3600
+    merged_test_df['Hours Worked'] = hours.where(hours > 0, hours + 24)
     return merged_test_df
 
 
-def get_building_name(file_name, sheet_name):
-    """ Uses Regex to extract the name of the building"""
-    df = pd.read_excel(file_name, sheet_name= sheet_name)
-    text = df.iloc[:1]['Unnamed: 1'][0]
-    
-    match = re.search(r'^([\w\s]+)\s(Weekly|employees)', text, re.IGNORECASE)
-    if match:
-        x = match.group(1)
-    else:
-        x = None
-
-    return x
+def minutes_since_midnight(times):
+    """ Turns "HH:MM:SS" strings (or datetimes) into minutes since midnight stored as int16, seconds are dropped """
+    if pd.api.types.is_integer_dtype(times):
+        return times.astype("int16")
+    if not pd.api.types.is_datetime64_any_dtype(times):
+        times = pd.to_datetime(times, format='%H:%M:%S')
+    return (times.dt.hour * 60 + times.dt.minute).astype("int16")
 
 
+def compact_shifts(df, holidays, trace=NULL_TRACE):
+    """Turns transformed shifts into the compact typed form every later step works on, and enriches them
+    parameters:
+    df: shifts (see ShiftStream) with Building Name and optionally Pay Period columns
+    holidays: list of holiday dates in 'YYYY-MM-DD' format
+    trace: optional PipelineTrace passed on to enrich_shifts
 
-def process_hours(df):
+    returns:
+    a new dataframe where employee, building and pay period are categories, time in and out are minutes since midnight (int16),
+    the date is a datetime64 day, hours worked is a float32 and week, year, month and holiday are small integers
     """
-    Takes a dataframe and categorizes the total hours by each employee into three categories (holliday, regular and overtime hours)
+    compact = pd.DataFrame({
+        #names are stripped once here, the categories are shared by every row of the same employee
+        'Employee Name': df['Employee Name'].astype(str).str.strip().astype("category"),
+        'Date': pd.to_datetime(df['Date']).dt.normalize(),
+        'Time In': minutes_since_midnight(df['Time In']),
+        'Time Out': minutes_since_midnight(df['Time Out']),
+        'Building Name': df['Building Name'].astype("category"),
+    })
+    if 'Pay Period' in df:
+        compact['Pay Period'] = df['Pay Period'].astype("category")
 
-    """
+    return enrich_shifts(compact, holidays, trace=trace)
 
-    # Create a new DataFrame with the desired columns
-    result = pd.DataFrame(columns=['Employee Name', 'Week of Year', 'Holiday Hours', 'Regular Hours', 'Overtime Hours'])
 
-    df['Employee Name'] = df['Employee Name'].str.strip() #removes any white spaces that may be created by mistake
-    
-    # Group the data by employee and week of year
-    grouped = df.groupby(['Employee Name', 'Week of year'])
-    
-    # Iterate over each group and calculate the hours
-    for name, group in grouped:
-        holiday_hours = group[group['holiday'] == 1]['Hours Worked'].sum()
-        regular_hours = group[group['holiday'] == 0]['Hours Worked'].sum()
-        overtime_hours = 0
-        if regular_hours > 40:
-            overtime_hours = regular_hours - 40
-            regular_hours = 40
-            
-            
-        result = result.append({'Employee Name': name[0], 'Week of Year': name[1], 'Holiday Hours': holiday_hours, 'Regular Hours': regular_hours, 'Overtime Hours': overtime_hours}, ignore_index=True)
-
-    return result
-
-def process_hours_show_month_year(df):
-    """
-    Takes a dataframe and categorizes the total hours by each employee into three categories (holliday, regular and overtime hours)
+def concat_shifts(df_list):
+    """ Concatenates shift dataframes while keeping their categorical columns categorical (pd.concat would turn them into objects) """
+    df_list = [df for df in df_list if df is not None]
+    if len(df_list) == 0:
+        raise ValueError("No shifts to concatenate")
+
+    for column in df_list[0].columns:
+        if all(isinstance(df[column].dtype, pd.CategoricalDtype) for df in df_list if column in df):
+            categories = pd.api.types.union_categoricals([df[column] for df in df_list if column in df]).categories
+            df_list = [df.assign(**{column: df[column].cat.set_categories(categories)}) if column in df else df for df in df_list]
+
+    return pd.concat(df_list, axis=0, ignore_index=True)
+
 
+def enrich_shifts(df, holidays, trace=NULL_TRACE):
+    """Adds the columns the next steps need: holiday, Week of year, Year, Month and Hours Worked
+    parameters:
+    df: transformed shifts with Date, Time In and Time Out columns
+    holidays: list of holiday dates in 'YYYY-MM-DD' format
+    trace: optional PipelineTrace that records the calendar and hours_worked stages
+
+    returns:
+    the same dataframe with the additional columns, each one computed on the whole column at once
     """
+    with trace.stage("calendar") as record:
+        df['Date'] = pd.to_datetime(df['Date'])
 
-    # Create a new DataFrame with the desired columns
-    result = pd.DataFrame(columns=['Employee Name', 'Year', 'Month', 'Holiday Hours', 'Regular Hours', 'Overtime Hours'])
+        #holidays are kept in a date index so checking every shift is a single lookup instead of comparing strings row by row
+        holiday_dates = pd.DatetimeIndex(pd.to_datetime(holidays)).normalize()
+        df['holiday'] = df['Date'].dt.normalize().isin(holiday_dates).astype("int8")
+
+        df['Week of year'] = df['Date'].dt.isocalendar().week.astype("int8")
+        df['Year'] = df['Date'].dt.year.astype("int16")
+        df['Month'] = df['Date'].dt.month.astype("int8")
+        record["rows"] = len(df)
+
+    with trace.stage("hours_worked") as record:
+        df = hours_worked(df)
+        record["rows"] = len(df)
+
+    return df
 
-    df['Employee Name'] = df['Employee Name'].str.strip() #removes any white spaces that may be created by mistake
-    
-    # Group the data by employee and week of year
-    grouped = df.groupby(['Employee Name', 'Week of year'])
-    
-    # Iterate over each group and calculate the hours
-    for name, group in grouped:
-        holiday_hours = group[group['holiday'] == 1]['Hours Worked'].sum()
-        regular_hours = group[group['holiday'] == 0]['Hours Worked'].sum()
-        overtime_hours = 0
-        if regular_hours > 40:
-            overtime_hours = regular_hours - 40
-            regular_hours = 40
-            
-            
-        result = result.append({'Employee Name': name[0], 'Week of Year': name[1], 'Holiday Hours': holiday_hours, 'Regular Hours': regular_hours, 'Overtime Hours': overtime_hours}, ignore_index=True)
-
-def convert_df(df):
-    df = df.sort_values(by="Employee Name", ascending=True)
-    # IMPORTANT: Cache the conversion to prevent computation on every rerun
-    return df.to_csv().encode('utf-8')
-
-def transform_schedule_week2(file_name, sheet_name):
-    """ This function transforms the user input schedule into a format that can be further analyzed
-    
-    parameters: 
-    file_name: excel or xlsx file format
-    sheet_name: name of the sheet as in excel file
+
+def classify_hours(df, keys, rules=None):
+    """
+    Splits the hours worked into holiday, regular, overtime and double time hours for every group of keys, all groups at once
+
+    parameters:
+    df: shifts with Employee Name, Building Name, Date, Time In, Time Out, holiday and Hours Worked columns plus the grouping keys
+    keys: columns to group by, for ex. ['Employee Name', 'Week of year']
+    rules: optional PayRules or dict of pay rules (see pay_rules.py), overtime past 40 regular hours a week by default.
+    A group worked in buildings with different weekly thresholds uses the lowest of them
 
     returns:
-    A dataframe that contains four columns, employee name, date, hour in, hour out
+    A dataframe with one row per group, the keys plus Holiday Hours, Regular Hours, Overtime Hours, Double Time Hours
+    and Daily Overtime Hours (the part of the overtime that comes from the daily rules)
+
+    """
+    rules = PayRules.of(rules)
+    df['Employee Name'] = _strip_names(df['Employee Name']) #removes any white spaces that may be created by mistake
+
+    #holiday shifts count as holiday hours, every other shift counts towards the regular hours of its group unless a daily rule makes it overtime
+    split = rules.split_shifts(df).rename(columns={'Overtime Hours': 'Daily Overtime Hours'})
+    totals = df[keys].assign(**split, **{'Weekly Threshold': rules.weekly_thresholds(df['Building Name'])})
+    totals = totals.groupby(keys, sort=True, observed=True).agg({'Holiday Hours': 'sum', 'Regular Hours': 'sum', 'Daily Overtime Hours': 'sum',
+                                                                  'Double Time Hours': 'sum', 'Weekly Threshold': 'min'})
+    totals['Overtime Hours'] = totals['Daily Overtime Hours']
+
+    totals = apply_weekly_cap(totals, totals.pop('Weekly Threshold'))
+    return totals[['Holiday Hours', 'Regular Hours', 'Overtime Hours', 'Double Time Hours', 'Daily Overtime Hours']].reset_index()
+
+
+def apply_weekly_cap(totals, weekly_cap=40):
+    """ Moves the Regular Hours of every row above weekly_cap (a number, or one per row) into Overtime Hours, adding to the overtime already there """
+    #a NaN cap would turn the hours of its rows into NaN, which add up to 0
+    if pd.isna(np.asarray(weekly_cap, dtype="float64")).any():
+        raise ValueError("Weekly cap is missing for some rows, every row needs a number of hours")
+    #anything above the cap is overtime
+    overtime = (totals['Regular Hours'] - weekly_cap).clip(lower=0)
+    totals['Overtime Hours'] = (totals['Overtime Hours'] if 'Overtime Hours' in totals else 0) + overtime
+    totals['Regular Hours'] = totals['Regular Hours'] - overtime
+    return totals
+
+
+def _strip_names(names):
+    """ Strips white space from names, categorical names are stripped on their categories instead of on every row """
+    if isinstance(names.dtype, pd.CategoricalDtype):
+        stripped = names.cat.categories.str.strip()
+        if stripped.equals(names.cat.categories):
+            return names
+        return names.astype(str).str.strip().astype("category")
+    return names.str.strip()
+
+
+def process_hours(df, rules=None):
+    """
+    Takes a dataframe and categorizes the total hours by each employee into four categories (holliday, regular, overtime and double time hours)
+    rules: optional pay rules (see classify_hours)
 
     """
-    #read excel file
-    df = pd.read_excel(file_name, sheet_name= sheet_name)
-
-    #remove first row which usually contains the name of the building for ex. hamilton cove
-    df = df.iloc[1:]
-
-    #replace null values with a string called unknown, this will help us down the road
-    df= df.replace(np.NaN, "Unknown").reset_index(drop=True).iloc[:,1:].reset_index(drop=True)
-
-    # #find the index of the first week, from here you will determine where the first week starts 
-    index_of_first_week = df[df['Unnamed: 1'].str.contains("Date") == True].index[0]
-    index_of_second_week = df[df['Unnamed: 1'].str.contains("Date") == True].index[1]
-
-    # #rename columns of the dataframe to match that the row of where the first week starts, the columns are now dates that start from 1/16 to 1/22 (first week only)
-    df.columns = df.iloc[index_of_second_week]
-    df = df.iloc[index_of_second_week:, : ].reset_index(drop=True)
-
-    #lets drop any unknown value in the Date column, if there are no employees why keep it?
-    #The date column is just called DATE but in reality that column contains names of each employee
-    df = df[df['Date'] !="Unknown"].reset_index(drop =True)
-    df = df[df['Date'] !="Name of Employee"].reset_index(drop =True)
-    df = df[df['Date'] !="Date"].reset_index(drop =True)
-    
-    #unpivot the date while fixing the name of the employee
-    melt_df = pd.melt(df, id_vars="Date")
-    
-    #clean up the melt dataframe by removing any employee without work hours, and remove any text like the word "day"
-    melt_df = melt_df[melt_df['value'] !="Unknown"].reset_index(drop =True)
-    melt_df = melt_df[melt_df['Date'] !="Day"].reset_index(drop =True)
-
-    #some rows that contain total hours get pulled in, but we only need the time worked, our strategy to keep only hourly date was to focus on strings with the : format
-    melt_df['value'] = melt_df['value'].astype("str")
-    melt_df = melt_df[melt_df['value'].str.contains(":")]
-
-    #rename some of the columns
-    melt_df = melt_df.rename(columns={"Date":"Employee Name", "value":"Hours"})
-    melt_df.columns.values[1] = "Date"
-  
-
-    # we found an interesting pattern, if the Date had an unknown string, that meant that the this is the time out, but if they had a time instead, that meant time in. 
-    # so we split the data into test_df1 and test_df2 that we could then merge
-    df1 = melt_df[melt_df['Date'] != "Unknown"].reset_index(drop=True)
-    df1 = df1.rename(columns={"Hours":"Time In"})
-    
-    df2 = melt_df[melt_df['Date'] == "Unknown"].reset_index(drop=True)
-    df2 = df2.rename(columns={"Hours":"Time Out"})
-    df2 = df2[["Time Out"]]
-    
-    merged_df = pd.merge(left=df1, right=df2, left_index=True, right_index=True)
-
-    return   merged_df
-
-def extract_hourly_rates(file_name , sheet_name):
+    # Group the data by employee and week of year
+    result = classify_hours(df, ['Employee Name', 'Week of year'], rules=rules)
+    result = result.rename(columns={'Week of year': 'Week of Year'})
+
+    return result[['Employee Name', 'Week of Year', 'Holiday Hours', 'Regular Hours', 'Overtime Hours', 'Double Time Hours']]
 
+def process_hours_show_month_year(df, rules=None):
     """
-    This function extracts the hourly rates of each employee in a schedule and aggregates the data by employee.
+    Takes a dataframe and categorizes the total hours by each employee into four categories (holliday, regular, overtime and double time hours)
+    for every week, keeping the year and month the hours belong to
+    rules: optional pay rules (see classify_hours)
+
     """
-    #read excel file from the file name and sheet name path
-    df = pd.read_excel(file_name, sheet_name)
-    #remove any text that contains employee, day, employees, date, total hours from column 17 (total hours) and column index 1 (employee name)
-    df = df[~df.iloc[:, 17].astype(str).str.contains("Employees|Day|Employee|Date|total hours", na=False) & 
-                    ~df.iloc[:, 1].astype(str).str.contains("Employees|Day|Employee|Date|total hours", na=False)]
-    #r column is the hourly rate column, drop all na and turn to a list
-    r_column = df.iloc[:, 17].dropna().tolist()
-    #b column is the employee name column, drop all na and turn to a list
-    b_column = df.iloc[:, 1].dropna().tolist()
-    #create a new dataframe and name it hourly rates df, transpose it and rename the columns to human readable values
-    hourly_rates_df = pd.DataFrame([r_column, b_column]).T.rename(columns={0:"Hourly Rate", 1:"Employee Name"})
-    #change data type of hourly rate into float
-    hourly_rates_df['Hourly Rate'] = hourly_rates_df['Hourly Rate'].astype("float")
-    #group by employee name and get the average of hourly rate
-    hourly_rates_df = hourly_rates_df.groupby("Employee Name").agg({"Hourly Rate":"mean"}).reset_index()
-    #set the employee name to be the index 
-    hourly_rates_df = hourly_rates_df.set_index("Employee Name")
+    # Group the data by employee, week of year, year and month
+    result = classify_hours(df, ['Employee Name', 'Week of year', 'Year', 'Month'], rules=rules)
+    result = result.rename(columns={'Week of year': 'Week of Year'})
 
-    return hourly_rates_df
+    return result[['Employee Name', 'Year', 'Month', 'Week of Year', 'Holiday Hours', 'Regular Hours', 'Overtime Hours', 'Double Time Hours']]
 
 def find_employee_names(df):
     names = df['Employee Name'].apply(lambda x: f"{x.split()[-1]} {x.split()[0]}")
     return names
 
-def process_hours_version_2(df):
+def process_hours_version_2(df, rules=None):
     """
-    Takes a dataframe and categorizes the total hours by each employee into three categories (holliday, regular and overtime hours)
+    Takes a dataframe and categorizes the total hours by each employee into four categories (holliday, regular, overtime and double time hours)
+    for every week, month and building the employee worked in
+    rules: optional pay rules (see classify_hours)
 
     """
+    # Group the data by employee, week of year, year, month and building
+    result = classify_hours(df, ['Employee Name', 'Week of year', 'Year', 'Month', 'Building Name'], rules=rules)
 
-    # Create a new DataFrame with the desired columns
-    result = pd.DataFrame(columns=['Employee Name', 'Month', 'Holiday Hours', 'Regular Hours', 'Overtime Hours'])
+    return result[['Employee Name', 'Month', 'Year', 'Building Name', 'Holiday Hours', 'Regular Hours', 'Overtime Hours', 'Double Time Hours']]
 
-    df['Employee Name'] = df['Employee Name'].str.strip() #removes any white spaces that may be created by mistake
-    
-    # Group the data by employee and week of year
-    grouped = df.groupby(['Employee Name', 'Week of year', 'Year', 'Month', 'Building Name'])
-    
-    # Iterate over each group and calculate the hours
-    for name, group in grouped:
-        holiday_hours = group[group['holiday'] == 1]['Hours Worked'].sum()
-        regular_hours = group[group['holiday'] == 0]['Hours Worked'].sum()
-        overtime_hours = 0
-        if regular_hours > 40:
-            overtime_hours = regular_hours - 40
-            regular_hours = 40
-        
-        month = group.loc[:,'Month']
-            
-            
-        result = result.append({'Employee Name': name[0], 'Month': name[3], 'Year':name[2], 'Building Name': name[4], 'Holiday Hours': holiday_hours, 'Regular Hours': regular_hours, 'Overtime Hours': overtime_hours}, ignore_index=True)
-
-    return result
-
-def extract_hourly_rates(file_name , sheet_name):
+def employee_hours_summary(df, trace=NULL_TRACE, rules=None, show_names=True):
+    """
+    Total holiday, regular, overtime and double time hours of each employee for the whole period, overtime is counted week by week
+    (and day by day when the pay rules have daily thresholds). Employee names are shown as "last name first name", or kept
+    as written on the schedule when show_names is False (for ex. to look up their hourly rates)
+
+    """
+    # returns a dataframe breaking down tot. hours worked into regular, overtime, double time and holiday hours by employee for each week
+    with trace.stage("process_hours") as record:
+        final_df = process_hours(df, rules=rules)
+        record["rows"] = len(final_df)
+
+    return employee_totals(final_df, show_names=show_names)
 
+
+def employee_totals(final_df, show_names=True):
+    """ Adds up weekly hours (see process_hours) by employee, names are shown as "last name first name" unless show_names is False """
+    #names are grouped as text so the summary stays in alphabetical order whatever order the shifts were read in
+    final_df = final_df.assign(**{'Employee Name': final_df['Employee Name'].astype(str)})
+    grouped_final_view = final_df.groupby("Employee Name").agg({"Holiday Hours":"sum", "Regular Hours":"sum", "Overtime Hours":"sum", "Double Time Hours":"sum"})
+    grouped_final_view = grouped_final_view.reset_index(drop=False)
+    if show_names:
+        grouped_final_view['Employee Name'] = find_employee_names(grouped_final_view)
+    return grouped_final_view
+
+
+def hours_by_building(df):
+    """ Total hours worked in each building, smallest first """
+    return df.groupby(["Building Name"], observed=True).agg({"Hours Worked":"sum"}).reset_index().sort_values(by="Hours Worked", ascending=True)
+
+
+def payroll_lines(df, hourly_rates_df, trace=NULL_TRACE, multipliers=None, rules=None):
     """
-    This function extracts the hourly rates of each employee in a schedule and aggregates the data by employee.
+    Pay of each employee for every week, month and building they worked in. Overtime and holiday hours are paid 1.5x the hourly rate by default,
+    double time hours 2x
+
+    parameters:
+    df: enriched shifts (see enrich_shifts)
+    hourly_rates_df: hourly rate of each employee indexed by employee name, or a RateTable built once for the whole period
+    trace: optional PipelineTrace that records the process_hours_version_2 and pay stages
+    multipliers: optional dict overriding the multiplier of "Overtime Hours", "Holiday Hours" or "Double Time Hours" (see payroll_engine.PAY_MULTIPLIERS)
+    rules: optional pay rules deciding which hours are overtime or double time (see pay_rules.py)
+
+    returns:
+    the hours of process_hours_version_2 with Hourly Rate, Regular Hours Pay, Overtime Pay, Holiday Pay, Double Time Pay and Total Pay columns
+
     """
-    #read excel file from the file name and sheet name path
-    df = pd.read_excel(file_name, sheet_name)
-    #remove any text that contains employee, day, employees, date, total hours from column 17 (total hours) and column index 1 (employee name)
-    df = df[~df.iloc[:, 17].astype(str).str.contains("Employees|Day|Employee|Date|total hours", na=False) & 
-                    ~df.iloc[:, 1].astype(str).str.contains("Employees|Day|Employee|Date|total hours", na=False)]
-    # #r column is the hourly rate column, drop all na and turn to a list
-    r_column = df.iloc[:, 17].dropna().tolist()
-    # #b column is the employee name column, drop all na and turn to a list
-    b_column = df.iloc[:, 1].dropna().tolist()
-    # #create a new dataframe and name it hourly rates df, transpose it and rename the columns to human readable values
-    hourly_rates_df = pd.DataFrame([r_column, b_column]).T.rename(columns={0:"Hourly Rate", 1:"Employee Name"})
-    # #change data type of hourly rate into float
-    hourly_rates_df['Hourly Rate'] = hourly_rates_df['Hourly Rate'].astype("float")
-    # #group by employee name and get the average of hourly rate
-    hourly_rates_df = hourly_rates_df.groupby("Employee Name").agg({"Hourly Rate":"mean"}).reset_index()
-    # #set the employee name to be the index 
-    hourly_rates_df = hourly_rates_df.set_index("Employee Name")
+    engine = PayrollCostEngine(hourly_rates_df, multipliers=multipliers)
 
-    return hourly_rates_df.fillna(17)
+    with trace.stage("process_hours_version_2") as record:
+        df = process_hours_version_2(df, rules=rules)
+        record["rows"] = len(df)
+
+    with trace.stage("pay") as record:
+        df = engine.pay_lines(df)
+        record["rows"] = len(df)
+    return df
+
+
+def payroll_by_building(df, hourly_rates_df, trace=NULL_TRACE, multipliers=None, rules=None):
+    """
+    Calculates payroll in $ by building, month and year. Overtime and holiday hours are paid 1.5x the hourly rate by default
+
+    parameters:
+    df: enriched shifts (see enrich_shifts)
+    hourly_rates_df: hourly rate of each employee indexed by employee name, or a RateTable
+    trace: optional PipelineTrace that records the process_hours_version_2 and pay stages
+    multipliers: optional dict overriding the pay multipliers (see payroll_lines)
+    rules: optional pay rules (see payroll_lines)
+
+    """
+    return summarize_payroll(payroll_lines(df, hourly_rates_df, trace=trace, multipliers=multipliers, rules=rules))
+
+
+def ingest_workbooks(files, sheet_name, max_workers=None, cache=None, trace=NULL_TRACE, holidays=HOLIDAYS, pool=None):
+    """ Parses the workbooks of a pay period on a pool of processes, one file per task
+
+    A workbook that can't be parsed doesn't stop the batch, its result carries the error instead.
+
+    parameters:
+    files: list of paths or uploaded files (excel or xlsx file format)
+    sheet_name: name of the sheet as in excel file, a list of sheet names, or None to read every tab that looks like a pay period
+    max_workers: number of processes to use, defaults to one per CPU core
+    cache: optional WorkbookCache, a file whose bytes and sheet were parsed before is taken from it instead of being parsed again
+    trace: optional PipelineTrace, every file gets its read, stream_shifts (streaming extraction + compact_shifts) and extract_hourly_rates stages recorded
+    holidays: list of holiday dates in 'YYYY-MM-DD' format used to flag holiday shifts
+    pool: optional WorkerPool shared between runs, every file is parsed on it (even a single one) and max_workers is ignored
+
+    returns:
+    A generator that yields one dict per file as soon as that file is done, with the keys
+    file_name, key (hash of the file bytes and sheet name), building_name, tabs (the tabs that were read),
+    shifts (both weeks of every tab with Building Name and Pay Period columns, in the compact enriched form of compact_shifts),
+    hourly_rates and error (None when the file was parsed)
+
+    """
+    jobs = []
+    for file in files:
+        file_name, source = _file_label(file), _file_source(file)
+        key = workbook_key(source, sheet_name, holidays)
+
+        cached = None
+        if cache is not None:
+            with trace.stage("cache", file_name=file_name) as record:
+                cached = cache.get(key)
+                record["rows"] = len(cached['shifts']) if cached is not None else 0
+        if cached is not None:
+            yield dict(cached, file_name=file_name)
+        else:
+            jobs.append((file_name, source, key))
+
+    for result in _parse_workbooks(jobs, sheet_name, holidays, max_workers, trace.enabled, pool):
+        #stages traced in the worker process come back with the result
+        trace.extend(result.pop('trace'))
+        if cache is not None and result['error'] is None:
+            cache.put(result['key'], result)
+        yield result
+
+
+def _parse_workbooks(jobs, sheet_name, holidays, max_workers, traced, pool=None):
+    """ Runs _ingest_workbook for every (file name, source, key) job and yields the results as they finish """
+    if pool is not None:
+        yield from _collect(pool, jobs, sheet_name, holidays, traced)
+        return
+
+    #a single file is faster to parse right here than to ship to another process
+    if max_workers == 1 or len(jobs) <= 1:
+        for file_name, source, key in jobs:
+            yield dict(_ingest_workbook(file_name, source, sheet_name, holidays, traced), key=key)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from _collect(executor, jobs, sheet_name, holidays, traced)
+
+
+def _collect(pool, jobs, sheet_name, holidays, traced):
+    """ Submits the jobs to pool (a ProcessPoolExecutor or a WorkerPool) and yields their results as they finish """
+    futures = {pool.submit(_ingest_workbook, file_name, source, sheet_name, holidays, traced): (file_name, key) for file_name, source, key in jobs}
+    for future in as_completed(futures):
+        file_name, key = futures[future]
+        try:
+            result = future.result()
+        except Exception as error:
+            #the worker process itself died (for ex. out of memory), report it against the file it was parsing
+            result = _failed_workbook(file_name, error)
+        yield dict(result, key=key)
+
+
+class WorkerPool:
+    """ Process pool shared by every run, for ex. by every session of the app
+
+    Processes are started on the first submit and reused after that. When a worker dies the pool can't take new work
+    anymore, so a new one is started on the next submit. The default leaves one core free for the process that serves
+    the app, so other users keep getting answers during a long run.
+
+    parameters:
+    max_workers: number of processes, defaults to one less than the number of CPU cores (at least one)
+
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 1) - 1)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            try:
+                return self._executor.submit(fn, *args)
+            except BrokenProcessPool:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                return self._executor.submit(fn, *args)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def in_background(iterable, heartbeat=0.25):
+    """ Runs iterable on a background thread and yields its items from the calling one
+
+    While nothing new has come back for heartbeat seconds None is yielded instead, so the caller can keep a progress
+    display alive. An exception raised by the iterable is raised again in the caller.
+    """
+    items = queue.Queue()
+    done = object()
+
+    def run():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except BaseException as error:
+            items.put((done, error))
+        else:
+            items.put((done, None))
+
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        try:
+            item, error = items.get(timeout=heartbeat)
+        except queue.Empty:
+            yield None
+            continue
+        if item is done:
+            if error is not None:
+                raise error
+            return
+        yield item
+
+
+def _ingest_workbook(file_name, source, sheet_name, holidays=HOLIDAYS, traced=False):
+    """ Streams the tabs of one workbook into compact shifts and hourly rates, runs inside a worker process """
+    trace = PipelineTrace() if traced else NULL_TRACE
+    try:
+        with trace.stage("read", file_name=file_name):
+            if isinstance(source, bytes):
+                source = io.BytesIO(source)
+            workbook = _open_workbook(source)
+
+        df_list = []
+        hourly_rates_list = []
+        building_names = []
+        try:
+            tabs = _select_tabs(workbook, [sheet_name] if isinstance(sheet_name, str) else sheet_name, PERIOD_TAB_PATTERN, file_name)
+            for tab in tabs:
+                #with several tabs each step is reported per tab
+                stage_file_name = file_name if len(tabs) == 1 else "{} [{}]".format(file_name, tab)
+
+                stream = ShiftStream(_worksheet(workbook, tab).iter_rows(values_only=True), tab, file_name=file_name)
+                with trace.stage("stream_shifts", file_name=stage_file_name) as record:
+                    for batch in stream:
+                        batch['Pay Period'] = tab
+                        #every later step works on the compact form, each batch is converted as soon as it is read
+                        df_list.append(compact_shifts(batch, holidays))
+                    record["rows"] = stream.shift_count
+
+                with trace.stage("extract_hourly_rates", file_name=stage_file_name) as record:
+                    hourly_rates = stream.hourly_rates()
+                    record["rows"] = len(hourly_rates)
+                hourly_rates_list.append(hourly_rates)
+                building_names.append(stream.building_name)
+        finally:
+            workbook.close()
+
+        #an employee on several tabs gets the average of their rates, like the two weeks of one tab
+        hourly_rates = hourly_rates_list[0] if len(hourly_rates_list) == 1 else pd.concat(hourly_rates_list).groupby(level=0).mean()
+
+        return {"file_name": file_name, "building_name": building_names[0], "tabs": list(tabs),
+                "shifts": concat_shifts(df_list), "hourly_rates": hourly_rates, "error": None, "trace": trace.records}
+    except Exception as error:
+        return dict(_failed_workbook(file_name, error), trace=trace.records)
+
+
+def _failed_workbook(file_name, error):
+    return {"file_name": file_name, "building_name": None, "tabs": [], "shifts": None, "hourly_rates": None,
+            "error": "{}: {}".format(type(error).__name__, error), "trace": []}
+
+
+def _file_label(file):
+    """ Name used to report on a file, uploaded files carry their original name """
+    if isinstance(file, (str, os.PathLike)):
+        return os.path.basename(file)
+    return getattr(file, "name", str(file))
+
+
+def _file_source(file):
+    """ Paths are sent to the worker as they are, uploaded files are sent as bytes so they can be pickled """
+    if isinstance(file, (str, os.PathLike)):
+        return os.fspath(file)
+    if hasattr(file, "getvalue"):
+        return file.getvalue()
+    file.seek(0)
+    return file.read()
+
+
+def workbook_key(source, sheet_name, holidays=()):
+    """ Identifies a parsed workbook by the sha256 of its bytes (or of the file at that path), the sheet name(s) and the holidays it was flagged with """
+    digest = hashlib.sha256()
+    if isinstance(source, bytes):
+        digest.update(source)
+    else:
+        with open(source, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(block)
+    if sheet_name is None:
+        sheet_name = "tabs matching {}".format(PERIOD_TAB_PATTERN)
+    elif not isinstance(sheet_name, str):
+        sheet_name = "|".join(str(name) for name in sheet_name)
+    return "{}:{}:{}".format(digest.hexdigest(), sheet_name, ",".join(sorted(holidays)))
+
+
+class WorkbookCache:
+    """ Keeps parsed workbooks in memory between runs, keyed by workbook_key
+
+    Once the cached dataframes take more than max_bytes, the least recently used workbooks are dropped.
+    Streamlit serves every session from its own thread, so all access goes through a lock.
+
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Returns the cached result for key, or None, and marks it as the most recently used """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, result):
+        """ Stores an ingested result, evicting the least recently used ones until it fits in the budget """
+        size = _result_size(result)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+
+            #a single workbook bigger than the whole budget is not worth evicting everything else for
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = (result, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def _result_size(result):
+    """ Memory used by the dataframes of an ingested result, in bytes """
+    return sum(int(frame.memory_usage(deep=True).sum()) for frame in (result['shifts'], result['hourly_rates']) if frame is not None)
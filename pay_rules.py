@@ -0,0 +1,159 @@
+"""
+Decides which hours are regular, overtime or double time, from rules declared as configuration instead of code.
+
+Rules are a dict (or a json file with the same content), every threshold is a number of hours or None when it doesn't apply:
+
+    {
+        "weekly_overtime": 40,
+        "daily_overtime": null,
+        "daily_double_time": null,
+        "buildings": {"Hamilton Cove": {"daily_overtime": 8, "daily_double_time": 12}}
+    }
+
+Daily thresholds are checked against the hours of each employee-day, shifts counted in the order they start, so the
+hours past the threshold land on the shift that crosses it. Hours past the daily overtime threshold are overtime, past the
+daily double time threshold double time. The weekly threshold applies to what is left as regular hours in a week, a
+week worked in buildings with different weekly thresholds uses the lowest of them.
+Building rules override the defaults for the shifts of that building, building names are matched as written on the
+schedule or without their Employees, Rover and Valet suffix. Holiday shifts are holiday hours whatever the rules.
+
+Every rule is applied to the whole shift table at once, a building with its own rules only changes the threshold of its rows.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+from payroll_engine import clean_building_names
+
+#thresholds every rule set has, in hours
+RULE_NAMES = ("weekly_overtime", "daily_overtime", "daily_double_time")
+
+#the rules used when none are given: overtime past 40 regular hours a week
+DEFAULT_RULES = {"weekly_overtime": 40, "daily_overtime": None, "daily_double_time": None, "buildings": {}}
+
+
+class PayRules:
+    """ Pay rules compiled into per-row thresholds
+
+    parameters:
+    rules: dict like DEFAULT_RULES (missing thresholds keep their default), raises ValueError on unknown names or bad values
+
+    """
+
+    def __init__(self, rules=None):
+        rules = dict(rules or {})
+        _check_names(rules, set(RULE_NAMES) | {"buildings"}, "pay rules")
+        self.defaults = _check_thresholds({name: rules.get(name, DEFAULT_RULES[name]) for name in RULE_NAMES}, "pay rules")
+
+        self.buildings = {}
+        for building, overrides in (rules.get("buildings") or {}).items():
+            _check_names(overrides, set(RULE_NAMES), "rules of {}".format(building))
+            self.buildings[str(building).strip()] = _check_thresholds(dict(self.defaults, **overrides), "rules of {}".format(building))
+
+    @classmethod
+    def of(cls, rules):
+        """ Returns rules unchanged when they already are PayRules """
+        return rules if isinstance(rules, cls) else cls(rules)
+
+    @classmethod
+    def load(cls, file):
+        """ Reads rules from a json file, file is a path or an open (or uploaded) file """
+        if isinstance(file, str):
+            with open(file) as opened:
+                return cls(json.load(opened))
+        return cls(json.load(file))
+
+    def to_dict(self):
+        return dict(self.defaults, buildings={building: dict(rules) for building, rules in self.buildings.items()})
+
+    def __eq__(self, other):
+        return isinstance(other, PayRules) and self.to_dict() == other.to_dict()
+
+    @property
+    def has_daily_rules(self):
+        return any(rules[name] is not None for rules in [self.defaults] + list(self.buildings.values())
+                   for name in ("daily_overtime", "daily_double_time"))
+
+    def thresholds(self, name, buildings):
+        """ Threshold of the rule name for each row of buildings (a Series of building names), inf where the rule doesn't apply """
+        default = _hours(self.defaults[name])
+        if not self.buildings:
+            return np.full(len(buildings), default)
+
+        def threshold(building):
+            building = str(building).strip()
+            rules = self.buildings.get(building) or self.buildings.get(clean_building_names(pd.Series([building]))[0])
+            return default if rules is None else _hours(rules[name])
+
+        #looked up once per distinct building, rows without a building (NaN doesn't map) get the default
+        distinct = pd.unique(buildings)
+        mapping = dict(zip(distinct, (threshold(building) for building in distinct)))
+        return pd.Series(buildings, copy=False).map(mapping).astype("float64").fillna(default).to_numpy(dtype="float64")
+
+    def split_shifts(self, df):
+        """
+        Splits the hours of every shift by the daily rules
+
+        parameters:
+        df: shifts with Employee Name, Building Name, Date, Time In, Time Out, holiday and Hours Worked columns
+
+        returns:
+        A dataframe aligned with df with Holiday Hours, Regular Hours, Overtime Hours and Double Time Hours. Regular hours
+        still have to go through the weekly threshold (see weekly_thresholds)
+
+        """
+        #hours are added up as float64 even when the shifts keep them as float32
+        hours = df['Hours Worked'].astype("float64")
+        holiday = df['holiday'] == 1
+        worked = hours.where(~holiday, 0)
+        split = pd.DataFrame({'Holiday Hours': hours.where(holiday, 0), 'Regular Hours': worked,
+                              'Overtime Hours': 0.0, 'Double Time Hours': 0.0}, index=df.index)
+        if not self.has_daily_rules:
+            return split
+
+        #hours of the employee-day up to the start and the end of each shift, shifts in the order they start. Shifts that start
+        #together are ordered by building (as text, categories follow the order files were read in) and end, so the same
+        #shifts get the same overtime whatever order the files finished in
+        ordered = df[['Employee Name', 'Date', 'Time In', 'Time Out']].assign(building=df['Building Name'].astype(str), worked=worked)
+        ordered = ordered.sort_values(['Date', 'Time In', 'building', 'Time Out'], kind="stable")
+        day_end = ordered.groupby(['Employee Name', 'Date'], observed=True, sort=False)['worked'].cumsum().reindex(df.index)
+        day_start = day_end - worked
+
+        overtime = _past(day_start, day_end, self.thresholds("daily_overtime", df['Building Name']))
+        double_time = _past(day_start, day_end, self.thresholds("daily_double_time", df['Building Name']))
+        #hours past both thresholds are double time only
+        overtime = np.maximum(overtime - double_time, 0)
+        split['Double Time Hours'] = double_time
+        split['Overtime Hours'] = overtime
+        split['Regular Hours'] = worked - overtime - double_time
+        return split
+
+    def weekly_thresholds(self, buildings):
+        """ Weekly threshold of each row of buildings, a group of rows (for ex. an employee-week) takes the lowest of its rows """
+        return self.thresholds("weekly_overtime", pd.Series(buildings, copy=False))
+
+
+def _past(start, end, threshold):
+    """ Hours of each shift (from start to end hours of its day) that are past threshold """
+    return (np.clip(end - threshold, 0, None) - np.clip(start - threshold, 0, None)).to_numpy(dtype="float64")
+
+
+def _hours(threshold):
+    return np.inf if threshold is None else float(threshold)
+
+
+def _check_names(rules, allowed, label):
+    unknown = sorted(set(rules) - allowed)
+    if unknown:
+        raise ValueError("Unknown {} in {}, expected one of {}".format(", ".join(unknown), label, ", ".join(sorted(allowed))))
+
+
+def _check_thresholds(rules, label):
+    for name in RULE_NAMES:
+        value = rules[name]
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+            raise ValueError("{} of {} should be a positive number of hours or null, got {!r}".format(name, label, value))
+    if rules["daily_overtime"] is not None and rules["daily_double_time"] is not None and rules["daily_double_time"] < rules["daily_overtime"]:
+        raise ValueError("daily_double_time of {} is lower than its daily_overtime".format(label))
+    return rules
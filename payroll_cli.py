@@ -0,0 +1,121 @@
+"""
+Runs the payroll pipeline without the streamlit app, for ex. from cron against a folder of schedules:
+
+    python payroll_cli.py schedules/ --sheet "1-16 to 1-29" --output-dir reports/
+    python payroll_cli.py schedules/ --all-tabs --output-dir reports/
+    python payroll_cli.py schedules/ --sheet "1-16 to 1-29" --rules pay_rules.json
+
+Writes auto-report (hours by employee), paychex-import (the same hours in the PayChex import layout), payroll_by_building
+and shifts (the normalized shifts), the same files the app lets you download, as csv by default (see --formats).
+Only pandas and openpyxl get imported (and only once there is work to do), streamlit and the plotting libraries never are.
+"""
+import argparse
+import glob
+import os
+import sys
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Calculates employee hours and payroll by building from a folder of excel schedules")
+    parser.add_argument("directory", help="folder that contains the xlsx schedules of the pay period")
+    tabs = parser.add_mutually_exclusive_group(required=True)
+    tabs.add_argument("--sheet", action="append", help='name of the tab in every excel file, for ex. "1-16 to 1-29", repeat it to read several tabs')
+    tabs.add_argument("--all-tabs", action="store_true", help="read every tab named like a pay period (for ex. a whole quarter) in one pass")
+    parser.add_argument("--output-dir", default=".", help="folder the reports are written to (default: current folder)")
+    parser.add_argument("--formats", nargs="+", choices=["csv", "xlsx", "parquet"], default=["csv"], help="formats every report is written in (default: csv), parquet needs pyarrow")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes used to parse the files (default: one per CPU core)")
+    parser.add_argument("--store", default=None, help="also add the period to this history database (see shift_store.py)")
+    parser.add_argument("--trace", default=None, help="write the time, rows and peak memory of every step to this json file")
+    parser.add_argument("--holidays", default=None, help="comma separated holiday dates in YYYY-MM-DD format (default: the list used by the app)")
+    #multipliers that aren't given come from payroll_engine.PAY_MULTIPLIERS
+    parser.add_argument("--overtime-multiplier", type=float, default=None, help="overtime hours are paid this multiple of the hourly rate (default: see PAY_MULTIPLIERS in payroll_engine.py)")
+    parser.add_argument("--holiday-multiplier", type=float, default=None, help="holiday hours are paid this multiple of the hourly rate (default: see PAY_MULTIPLIERS in payroll_engine.py)")
+    parser.add_argument("--double-time-multiplier", type=float, default=None, help="double time hours are paid this multiple of the hourly rate (default: see PAY_MULTIPLIERS in payroll_engine.py)")
+    parser.add_argument("--rules", default=None, help="json file of pay rules: weekly and daily overtime and double time thresholds, per building if needed (see pay_rules.py)")
+    return parser.parse_args(argv)
+
+
+def find_workbooks(directory):
+    """ Excel files in the folder, sorted by name, without the ~$ lock files excel leaves behind """
+    files = glob.glob(os.path.join(directory, "*.xlsx")) + glob.glob(os.path.join(directory, "*.xlsm"))
+    return sorted(file for file in files if not os.path.basename(file).startswith("~$"))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    files = find_workbooks(args.directory)
+    if not files:
+        print("No excel files found in {}".format(args.directory), file=sys.stderr)
+        return 2
+
+    #heavy imports happen here, after the arguments are checked
+    import helper_functions as x
+    from pipeline_trace import PipelineTrace, NULL_TRACE
+    from payroll_engine import PAY_MULTIPLIERS, RateTable, summarize_payroll
+    from pay_rules import PayRules
+    from report_export import available_formats, write_reports
+
+    missing_formats = sorted(set(args.formats) - set(available_formats()))
+    if missing_formats:
+        print("Can't write {} here, install pyarrow to write parquet files".format(", ".join(missing_formats)), file=sys.stderr)
+        return 2
+
+    holidays = args.holidays.split(",") if args.holidays else x.HOLIDAYS
+    trace = PipelineTrace() if args.trace else NULL_TRACE
+    multipliers = {"Overtime Hours": args.overtime_multiplier, "Holiday Hours": args.holiday_multiplier, "Double Time Hours": args.double_time_multiplier}
+    multipliers = {column: PAY_MULTIPLIERS[column] if value is None else value for column, value in multipliers.items()}
+    #bad rules stop the run before any file is parsed
+    try:
+        rules = PayRules.load(args.rules) if args.rules else PayRules()
+    except (OSError, ValueError) as error:
+        print("Could not read the pay rules {}: {}".format(args.rules, error), file=sys.stderr)
+        return 2
+
+    df_list = []
+    hourly_rates_list = []
+    failed = 0
+    sheet_name = None if args.all_tabs else args.sheet
+    for result in x.ingest_workbooks(files, sheet_name, max_workers=args.workers, trace=trace, holidays=holidays):
+        if result['error'] is not None:
+            print("Could not process {}: {}".format(result['file_name'], result['error']), file=sys.stderr)
+            failed += 1
+            continue
+        df_list.append(result['shifts'])
+        hourly_rates_list.append(result['hourly_rates'])
+        print("Processed {} ({})".format(result['file_name'], ", ".join(str(tab) for tab in result['tabs'])))
+
+    if not df_list:
+        print("None of the {} files could be processed".format(len(files)), file=sys.stderr)
+        return 1
+
+    df = x.concat_shifts(df_list)
+    #one rate per employee, shared by the report and the history
+    hourly_rates_df = RateTable(hourly_rates_list)
+
+    #names are kept as written for the PayChex rates, "last first" is only for the auto-report
+    employee_hours_df = x.employee_hours_summary(df, trace=trace, rules=rules, show_names=False)
+    shown_hours_df = employee_hours_df.assign(**{'Employee Name': x.find_employee_names(employee_hours_df)})
+    payroll_df = x.payroll_lines(df, hourly_rates_df, trace=trace, multipliers=multipliers, rules=rules)
+    frames = {"employee_hours": shown_hours_df, "paychex": employee_hours_df, "payroll_by_building": summarize_payroll(payroll_df), "shifts": df}
+    with trace.stage("export") as record:
+        paths = write_reports(frames, args.output_dir, args.formats, hourly_rates=hourly_rates_df)
+        record["rows"] = len(paths)
+
+    print("Wrote {}".format(", ".join(paths)))
+
+    if args.store:
+        from shift_store import ShiftStore
+        saved_periods = ShiftStore(args.store).save_periods(df, hourly_rates_df, multipliers=multipliers, rules=rules)
+        print("Saved {} to {}".format(", ".join(saved_periods), args.store))
+
+    if args.trace:
+        with open(args.trace, "w") as file:
+            file.write(trace.to_json())
+
+    #a partial run still writes the reports, but cron should know some files were skipped
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+"""
+One aggregation of a loaded pay period that every table, chart and download of the app is sliced from.
+
+The cube has one row per employee, building, year, month and ISO week (plus the monday the week starts on, for date filters),
+with the hours of each category (holiday, regular, overtime, double time) and their pay. Overtime in the cube is split per
+building and month like payroll_lines does; the employee summary re-applies the weekly threshold over the whole week from the
+same rows, the overtime that comes from daily rules is kept apart for that.
+"""
+import hashlib
+
+import pandas as pd
+
+import helper_functions as x
+from payroll_engine import PayrollCostEngine, RateTable, summarize_payroll
+from pay_rules import PayRules
+from pipeline_trace import NULL_TRACE
+
+#grain of the cube
+CUBE_KEYS = ['Employee Name', 'Building Name', 'Year', 'Month', 'Week of year', 'Week Start']
+
+#an employee-week, the unit that gets recalculated when a file changes
+WEEK_KEYS = ['Employee Name', 'Year', 'Week of year']
+
+HOUR_COLUMNS = ['Holiday Hours', 'Regular Hours', 'Overtime Hours', 'Double Time Hours']
+PAY_COLUMNS = ['Regular Hours Pay', 'Overtime Pay', 'Holiday Pay', 'Double Time Pay', 'Total Pay']
+
+
+def dataset_version(keys):
+    """ Names the data loaded from a set of files, from their workbook_key (see ingest_workbooks), whatever order they finished in """
+    digest = hashlib.sha256()
+    for key in sorted(keys):
+        digest.update(key.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def build_cube(df, hourly_rates, multipliers=None, trace=NULL_TRACE, rules=None):
+    """
+    Aggregates the shifts of a period into the cube
+
+    parameters:
+    df: enriched shifts (see ingest_workbooks and concat_shifts)
+    hourly_rates: RateTable, or hourly rates indexed by employee name
+    multipliers: optional pay multipliers (see payroll_lines)
+    trace: optional PipelineTrace that records the cube stage
+    rules: optional pay rules (see classify_hours)
+
+    returns:
+    A dataframe with the CUBE_KEYS, Hours Worked, the HOUR_COLUMNS, Daily Overtime Hours, Hourly Rate and the pay columns
+
+    """
+    with trace.stage("cube") as record:
+        shifts = df[['Employee Name', 'Building Name', 'Year', 'Month', 'Week of year', 'Date', 'Time In', 'Time Out', 'holiday', 'Hours Worked']]
+        shifts = shifts.assign(**{'Week Start': df['Date'] - pd.to_timedelta(df['Date'].dt.weekday, unit="D")})
+
+        cube = x.classify_hours(shifts, CUBE_KEYS, rules=rules)
+        cube = PayrollCostEngine(hourly_rates, multipliers=multipliers).pay_lines(cube)
+        cube.insert(len(CUBE_KEYS), 'Hours Worked', cube[HOUR_COLUMNS].sum(axis=1))
+        record["rows"] = len(cube)
+    return cube
+
+
+class IncrementalCube:
+    """ Cube of the files loaded so far, updated file by file
+
+    The shifts of every file are kept side by side with the file and the employee-week of each row. When a file is
+    added, replaced (same name, different bytes or tab) or removed, only the employee-weeks it has (or had) shifts in
+    are aggregated again, from the shifts every file has in those weeks. The rest of the cube is reused. A new file can
+    change the average rate of an employee anywhere, so the reused rows are re-priced with the new rate table in the
+    same vectorized pass as the pay lines (their hours are not recalculated).
+
+    parameters:
+    multipliers: optional pay multipliers (see payroll_lines)
+    rules: optional pay rules (see classify_hours)
+
+    """
+
+    def __init__(self, multipliers=None, rules=None):
+        self.multipliers = dict(multipliers or {})
+        self.rules = PayRules.of(rules)
+        #workbook_key and hourly rates of every file in the cube, by file name
+        self.keys = {}
+        self.hourly_rates = {}
+        self.rate_table = None
+        #shifts of every file, with the file name and the employee-week of each row
+        self.shifts = None
+        self._row_files = None
+        self._row_weeks = None
+        self.cube = None
+        self.version = dataset_version([])
+
+    def update(self, results, trace=NULL_TRACE):
+        """
+        Brings the cube up to date with the files of the period
+
+        parameters:
+        results: ingest_workbooks results of every file of the period, files of the cube that are not in them are removed.
+        Raises ValueError when two files have the same name
+        trace: optional PipelineTrace that records the cube stage
+
+        returns:
+        the names of the files that were added, replaced or removed
+
+        """
+        results = [result for result in results if result['error'] is None]
+        names = [result['file_name'] for result in results]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            #files are told apart by name, keeping only one of them would silently drop the shifts of the other
+            raise ValueError("Several files are named {}".format(", ".join(duplicates)))
+        results = {result['file_name']: result for result in results}
+        changed = sorted(name for name in set(results) | set(self.keys) if self.keys.get(name) != results.get(name, {}).get('key'))
+        if not changed:
+            return []
+
+        with trace.stage("cube", file_name=", ".join(changed)) as record:
+            added = [results[name] for name in changed if name in results]
+            self.keys = {name: result['key'] for name, result in results.items()}
+            self.hourly_rates = {name: result['hourly_rates'] for name, result in results.items()}
+            self.version = dataset_version(self.keys.values())
+
+            if not results:
+                self.rate_table = self.shifts = self._row_files = self._row_weeks = self.cube = None
+                record["rows"] = 0
+                return changed
+            self.rate_table = RateTable(list(self.hourly_rates.values()))
+
+            #rows of replaced and removed files go, the employee-weeks they were in have to be aggregated again
+            added_weeks = [_week_index(result['shifts']) for result in added]
+            if self.shifts is None:
+                kept_shifts, kept_files, kept_weeks, removed_weeks = [], [], [], None
+            else:
+                keep = ~self._row_files.isin(changed).to_numpy()
+                kept_shifts, kept_files, kept_weeks = [self.shifts[keep]], [self._row_files[keep]], [self._row_weeks[keep]]
+                removed_weeks = self._row_weeks[~keep]
+
+            self.shifts = x.concat_shifts(kept_shifts + [result['shifts'] for result in added])
+            self._row_files = pd.concat(kept_files + [pd.Series(result['file_name'], index=range(len(result['shifts']))) for result in added], ignore_index=True)
+            self._row_weeks = kept_weeks[0].append(added_weeks) if kept_weeks else added_weeks[0].append(added_weeks[1:])
+
+            if self.cube is None:
+                self.cube = build_cube(self.shifts, self.rate_table, self.multipliers, rules=self.rules)
+            else:
+                touched = removed_weeks.append(added_weeks).unique()
+                kept = self.cube[~_week_index(self.cube).isin(touched)]
+                kept = PayrollCostEngine(self.rate_table, multipliers=self.multipliers).pay_lines(kept)
+                fresh = build_cube(self.shifts[self._row_weeks.isin(touched)], self.rate_table, self.multipliers, rules=self.rules)
+                cube = x.concat_shifts([kept, fresh])
+                #buildings or employees that are gone shouldn't show up in pickers and charts
+                for column in ('Employee Name', 'Building Name'):
+                    cube[column] = cube[column].cat.remove_unused_categories()
+                self.cube = cube
+            record["rows"] = len(self.cube)
+        return changed
+
+    def set_multipliers(self, multipliers):
+        """ Re-prices the whole cube when the pay multipliers change, hours are kept """
+        multipliers = dict(multipliers or {})
+        if multipliers == self.multipliers:
+            return
+        self.multipliers = multipliers
+        if self.cube is not None:
+            self.cube = PayrollCostEngine(self.rate_table, multipliers=multipliers).pay_lines(self.cube)
+
+    def set_rules(self, rules):
+        """ Builds the whole cube again when the pay rules change, they decide the hours of every employee-week """
+        rules = PayRules.of(rules)
+        if rules == self.rules:
+            return
+        self.rules = rules
+        if self.cube is not None:
+            self.cube = build_cube(self.shifts, self.rate_table, self.multipliers, rules=rules)
+
+
+def _week_index(df):
+    """ Employee-week of every row, employee names as text so files with different name categories can be compared """
+    return pd.MultiIndex.from_arrays([df['Employee Name'].astype(str), df['Year'], df['Week of year']])
+
+
+def filter_cube(cube, buildings=None, start=None, end=None):
+    """
+    Keeps the rows of some buildings and of the weeks that overlap a date range
+
+    parameters:
+    buildings: list of building names, None keeps every building
+    start, end: first and last day of the range (dates), None leaves that side open
+
+    """
+    keep = pd.Series(True, index=cube.index)
+    if buildings is not None:
+        keep &= cube['Building Name'].isin(buildings)
+    if start is not None:
+        keep &= cube['Week Start'] > pd.Timestamp(start) - pd.Timedelta(days=7)
+    if end is not None:
+        keep &= cube['Week Start'] <= pd.Timestamp(end)
+    return cube[keep]
+
+
+def employee_hours(cube, rules=None, show_names=True):
+    """ Same table as employee_hours_summary: holiday, regular, overtime and double time hours of each employee, overtime counted week by week """
+    #the cube splits overtime by building and month, the weekly threshold applies to everything worked in the week that isn't already daily overtime
+    #a week worked in buildings with different weekly thresholds uses the lowest of them, like classify_hours
+    weeks = cube.assign(**{'Regular Hours': cube['Regular Hours'] + cube['Overtime Hours'] - cube['Daily Overtime Hours'],
+                           'Overtime Hours': cube['Daily Overtime Hours'],
+                           'Weekly Threshold': PayRules.of(rules).weekly_thresholds(cube['Building Name'])})
+    weeks = weeks.groupby(['Employee Name', 'Week of year'], sort=True, observed=True).agg(dict({column: 'sum' for column in HOUR_COLUMNS}, **{'Weekly Threshold': 'min'}))
+    weeks = x.apply_weekly_cap(weeks, weeks.pop('Weekly Threshold')).reset_index()
+    return x.employee_totals(weeks[['Employee Name'] + HOUR_COLUMNS], show_names=show_names)
+
+
+def hours_by_building(cube):
+    """ Same table as hours_by_building: total hours worked in each building, smallest first """
+    return cube.groupby(["Building Name"], observed=True).agg({"Hours Worked":"sum"}).reset_index().sort_values(by="Hours Worked", ascending=True)
+
+
+def payroll_by_building(cube):
+    """ Same table as payroll_by_building: $ spent by building, month and year """
+    return summarize_payroll(cube)
@@ -0,0 +1,120 @@
+"""
+Turns hours into $: looks up the hourly rate of every pay line and prices regular, overtime and holiday hours in one pass.
+
+The rates of every file go into one RateTable, deduplicated and indexed on a normalized employee key, so
+"Maria  Garcia " on one schedule and "maria garcia" on another share one rate and a pay line can never be joined twice.
+"""
+import numpy as np
+import pandas as pd
+
+#how much each kind of hour is paid, as a multiple of the hourly rate
+PAY_MULTIPLIERS = {"Regular Hours": 1.0, "Overtime Hours": 1.5, "Holiday Hours": 1.5, "Double Time Hours": 2.0}
+
+#pay column computed from each kind of hour, in the order they are added to the pay lines
+PAY_COLUMNS = {"Regular Hours": "Regular Hours Pay", "Overtime Hours": "Overtime Pay", "Holiday Hours": "Holiday Pay", "Double Time Hours": "Double Time Pay"}
+
+#words the schedules add after the building name, for ex. "Hamilton Cove Valet"
+BUILDING_SUFFIXES = ["Employees", "Rover", "Valet"]
+
+
+def employee_key(names):
+    """ Normalized employee names used to match rates: no leading, trailing or repeated spaces, lower case """
+    return _per_distinct(names, lambda distinct: distinct.astype(str).str.split().str.join(" ").str.lower())
+
+
+def clean_building_names(names):
+    """ Removes the Employees, Rover and Valet suffixes so schedules of the same building share one name """
+    def clean(distinct):
+        for suffix in BUILDING_SUFFIXES:
+            distinct = distinct.str.replace(suffix, '', regex=False)
+        return distinct.str.strip()
+    return _per_distinct(names, clean)
+
+
+def _per_distinct(values, func):
+    """ Applies func (which works on a Series of strings) once per distinct value and maps the result back onto every row """
+    distinct = pd.Series(pd.unique(values.dropna()), dtype=object)
+    mapping = dict(zip(distinct, func(distinct)))
+    return pd.Series(values, copy=False).map(mapping)
+
+
+class RateTable:
+    """ Hourly rate of every employee, one rate per employee
+
+    parameters:
+    hourly_rates: dataframe indexed by employee name with an Hourly Rate column (see ShiftStream.hourly_rates), or a list
+    of them (one per file). An employee found more than once gets the average of their rates.
+
+    """
+
+    def __init__(self, hourly_rates):
+        if isinstance(hourly_rates, (list, tuple)):
+            hourly_rates = pd.concat(hourly_rates, axis=0)
+        names = pd.Series(hourly_rates.index, index=hourly_rates.index).astype(str).str.strip()
+        keys = employee_key(names)
+
+        self.rates = hourly_rates['Hourly Rate'].astype("float64").groupby(keys.values).mean()
+        #the name shown for an employee is the first spelling found
+        self.names = pd.Series(names.values, index=keys.values).groupby(level=0).first()
+
+    @classmethod
+    def of(cls, hourly_rates):
+        """ Returns hourly_rates unchanged when it already is a RateTable """
+        return hourly_rates if isinstance(hourly_rates, cls) else cls(hourly_rates)
+
+    def __len__(self):
+        return len(self.rates)
+
+    def lookup(self, names):
+        """ Hourly rate of each name, NaN for employees without a rate """
+        return employee_key(names).map(self.rates)
+
+    def to_frame(self):
+        """ The table in the same shape as ShiftStream.hourly_rates: indexed by Employee Name with an Hourly Rate column """
+        df = pd.DataFrame({"Employee Name": self.names.reindex(self.rates.index).values, "Hourly Rate": self.rates.values})
+        return df.set_index("Employee Name")
+
+
+class PayrollCostEngine:
+    """ Prices hours with a rate table
+
+    parameters:
+    hourly_rates: RateTable, or what RateTable accepts
+    multipliers: optional dict overriding PAY_MULTIPLIERS, for ex. {"Overtime Hours": 2.0}
+
+    """
+
+    def __init__(self, hourly_rates, multipliers=None):
+        self.rate_table = RateTable.of(hourly_rates)
+        self.multipliers = dict(PAY_MULTIPLIERS, **(multipliers or {}))
+
+    def pay_lines(self, hours_df):
+        """
+        Adds Hourly Rate, Regular Hours Pay, Overtime Pay, Holiday Pay, Double Time Pay and Total Pay to hours_df (see process_hours_version_2)
+
+        Lines of employees without a rate get no pay (NaN), like the left join they replace
+        """
+        df = hours_df.copy()
+        rate = self.rate_table.lookup(df['Employee Name']).to_numpy(dtype="float64")
+        df['Hourly Rate'] = rate
+
+        #every kind of hour is priced at once: hours (lines x kinds) times rate x multiplier of each kind
+        hour_columns = list(PAY_COLUMNS)
+        multipliers = np.array([self.multipliers[column] for column in hour_columns])
+        pay = df[hour_columns].to_numpy(dtype="float64") * (rate[:, None] * multipliers)
+        for position, column in enumerate(hour_columns):
+            df[PAY_COLUMNS[column]] = pay[:, position]
+
+        df['Total Pay'] = df['Overtime Pay'] + df['Holiday Pay'] + df['Regular Hours Pay'] + df['Double Time Pay']
+        return df
+
+
+def summarize_payroll(df):
+    """ Adds up pay lines (see PayrollCostEngine.pay_lines) by building, month and year, building names are cleaned once per distinct name """
+    #buildings are grouped as text so the rows come out in alphabetical order whatever order the files were read in
+    df = df.assign(**{'Building Name': df['Building Name'].astype(str)})
+    df = df.groupby(['Building Name', 'Month', 'Year']).agg({"Total Pay":"sum", "Overtime Pay":"sum", "Regular Hours Pay":"sum", "Holiday Pay":"sum", "Double Time Pay":"sum"})
+    df = df.reset_index()
+    df['Year'] = df['Year'].astype("str")
+    df['Building Name'] = clean_building_names(df['Building Name'])
+    return df
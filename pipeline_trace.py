@@ -0,0 +1,85 @@
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+#tracemalloc is shared by the whole process (every streamlit session runs in it), traced stages take turns on it
+_TRACING_LOCK = threading.RLock()
+
+
+class PipelineTrace:
+    """ Records the wall time, number of rows and peak memory of every stage of a payroll run
+
+    Usage:
+        trace = PipelineTrace()
+        with trace.stage("compact_shifts", file_name="hamilton.xlsx") as record:
+            df = compact_shifts(...)
+            record["rows"] = len(df)
+
+    Peak memory is measured with tracemalloc, which only runs while a stage is being traced. Stages should not
+    be nested, the inner stage resets the peak of the outer one. tracemalloc is process-wide, so traced stages of
+    every trace in the process (for ex. two app sessions with diagnostics on) run one at a time, otherwise one
+    session would stop tracing or reset the peak under the other.
+
+    """
+    enabled = True
+
+    def __init__(self):
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, file_name=None):
+        record = {"stage": name, "file_name": file_name, "rows": None, "seconds": None, "peak_memory_mb": None}
+
+        with _TRACING_LOCK:
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            start = time.perf_counter()
+            try:
+                yield record
+            finally:
+                record["seconds"] = time.perf_counter() - start
+                record["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                if started_tracing:
+                    tracemalloc.stop()
+                self.records.append(record)
+
+    def extend(self, records):
+        """ Adds records traced somewhere else, for ex. in the worker process that parsed a file """
+        self.records.extend(records)
+
+    def to_frame(self):
+        return pd.DataFrame(self.records, columns=["stage", "file_name", "rows", "seconds", "peak_memory_mb"])
+
+    def to_json(self):
+        return json.dumps({"total_seconds": sum(record["seconds"] for record in self.records), "stages": self.records}, indent=2, default=str)
+
+
+class _NullTrace:
+    """ Stands in for PipelineTrace when diagnostics are off, every call is a no-op """
+    enabled = False
+    records = []
+
+    def stage(self, name, file_name=None):
+        return _NULL_STAGE
+
+    def extend(self, records):
+        pass
+
+
+class _NullStage:
+    def __enter__(self):
+        #callers write rows into the record, a throwaway dict keeps that working without keeping anything
+        return {}
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+NULL_TRACE = _NullTrace()
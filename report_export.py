@@ -0,0 +1,171 @@
+"""
+Turns the final tables of a run into downloadable files: CSV, Excel (xlsx) and Parquet.
+
+Reports:
+- employee_hours: holiday, regular, overtime and double time hours of each employee (auto-report)
+- paychex: the same hours in the PayChex import layout, one line per employee and kind of pay
+- payroll_by_building: $ spent by building, month and year
+- shifts: the normalized shifts every other report is calculated from
+
+Every format of a report is written in one go from the same frame. Excel files are streamed row by row with a
+write-only workbook, so the sheet is never held in memory as cells. Parquet needs pyarrow (or fastparquet), without
+it only csv and xlsx are available.
+"""
+import hashlib
+import importlib.util
+import io
+import json
+import os
+
+import pandas as pd
+from openpyxl import Workbook
+
+from payroll_engine import RateTable
+
+#file name and whether the csv keeps the index column, auto-report and payroll_by_building always had one
+REPORTS = {
+    "employee_hours": {"file_name": "auto-report", "index": True},
+    "paychex": {"file_name": "paychex-import", "index": False},
+    "payroll_by_building": {"file_name": "payroll_by_building", "index": True},
+    "shifts": {"file_name": "shifts", "index": False},
+}
+
+#mime type and extension of each format
+FORMATS = {
+    "csv": ("text/csv", ".csv"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", ".xlsx"),
+    "parquet": ("application/octet-stream", ".parquet"),
+}
+
+#PayChex pay component of each kind of hour, in the order the lines of an employee are written
+PAYCHEX_PAY_COMPONENTS = {"Regular Hours": "Hourly", "Overtime Hours": "Overtime", "Holiday Hours": "Holiday", "Double Time Hours": "Double Time"}
+
+PAYCHEX_COLUMNS = ["Worker ID", "Last Name", "First Name", "Pay Component", "Rate", "Hours"]
+
+
+def available_formats():
+    """ Formats that can be written here, parquet only when an engine for it is installed """
+    if importlib.util.find_spec("pyarrow") or importlib.util.find_spec("fastparquet"):
+        return list(FORMATS)
+    return [name for name in FORMATS if name != "parquet"]
+
+
+def export_key(*parts):
+    """ Names the input of an export, for ex. the dataset version, pay multipliers, pay rules and filters it was made from """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def paychex_layout(employee_hours_df, hourly_rates):
+    """
+    Employee hours (see employee_hours_summary) in the PayChex import layout
+
+    parameters:
+    employee_hours_df: hours of each employee, names as written on the schedule ("first name last name", see show_names)
+    hourly_rates: RateTable, or what RateTable accepts
+
+    returns:
+    A dataframe with the PAYCHEX_COLUMNS, one line per employee and pay component with hours, Worker ID is left empty
+
+    """
+    components = [column for column in PAYCHEX_PAY_COMPONENTS if column in employee_hours_df]
+    lines = employee_hours_df.melt(id_vars=['Employee Name'], value_vars=components, var_name='Pay Component', value_name='Hours')
+    lines = lines[lines['Hours'] > 0]
+    #the last word is the last name, everything before it the first name, a single word is a last name
+    names = lines['Employee Name'].astype(str).str.rsplit(n=1, expand=True).reindex(columns=[0, 1])
+    last_names = names[1].fillna(names[0])
+    first_names = names[0].where(names[1].notna(), "")
+
+    df = pd.DataFrame({
+        "Worker ID": "",
+        "Last Name": last_names.values,
+        "First Name": first_names.values,
+        "Pay Component": lines['Pay Component'].map(PAYCHEX_PAY_COMPONENTS).values,
+        "Rate": RateTable.of(hourly_rates).lookup(lines['Employee Name']).round(2).values,
+        "Hours": lines['Hours'].round(2).values,
+        "order": lines['Pay Component'].map({column: position for position, column in enumerate(components)}).values,
+    })
+    return df.sort_values(["Last Name", "First Name", "order"], kind="stable").drop(columns="order").reset_index(drop=True)
+
+
+def normalized_shifts(shifts):
+    """ Shifts (see compact_shifts) as plain columns: dates as days, time in and out as HH:MM, categories as text """
+    df = shifts.copy()
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(str)
+    for column in ('Time In', 'Time Out'):
+        if column in df and pd.api.types.is_integer_dtype(df[column]):
+            minutes = df[column].astype("int32")
+            df[column] = (minutes // 60).map("{:02d}".format) + ":" + (minutes % 60).map("{:02d}".format)
+    df['Date'] = df['Date'].dt.date
+    return df
+
+
+def report_frame(report, df, hourly_rates=None):
+    """ Final frame of a report from the table it is made from, hourly_rates is only needed by paychex """
+    if report == "employee_hours":
+        return df.sort_values(by="Employee Name", ascending=True)
+    if report == "paychex":
+        return paychex_layout(df, hourly_rates)
+    if report == "payroll_by_building":
+        return df
+    if report == "shifts":
+        return normalized_shifts(df)
+    raise ValueError("Unknown report {}, expected one of {}".format(report, ", ".join(REPORTS)))
+
+
+def export_report(report, df, formats=None, hourly_rates=None):
+    """
+    Writes one report in every format
+
+    parameters:
+    report: name of the report, see REPORTS
+    df: the table the report is made from (for paychex, the employee hours with show_names=False)
+    formats: list of formats, defaults to every available one
+    hourly_rates: RateTable, for the paychex report
+
+    returns:
+    dict of the bytes of each format
+
+    """
+    frame = report_frame(report, df, hourly_rates)
+    return {name: _write(frame, name, REPORTS[report]["index"]) for name in (formats or available_formats())}
+
+
+def write_reports(frames, directory, formats=None, hourly_rates=None):
+    """ Writes every report of frames ({report: table}) in every format to directory, returns the paths written """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for report, df in frames.items():
+        for name, data in export_report(report, df, formats, hourly_rates).items():
+            path = os.path.join(directory, REPORTS[report]["file_name"] + FORMATS[name][1])
+            with open(path, "wb") as file:
+                file.write(data)
+            paths.append(path)
+    return paths
+
+
+def _write(df, name, index):
+    if name == "csv":
+        return df.to_csv(index=index).encode('utf-8')
+    if name == "xlsx":
+        return _xlsx(df)
+    if name == "parquet":
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+    raise ValueError("Unknown format {}, expected one of {}".format(name, ", ".join(FORMATS)))
+
+
+def _xlsx(df):
+    """ Streams df into a write-only workbook, one row at a time """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([str(column) for column in df.columns])
+    #empty cells instead of NaN, excel has no NaN
+    values = df.astype(object).where(df.notna(), None)
+    for row in values.itertuples(index=False, name=None):
+        sheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
@@ -0,0 +1,153 @@
+"""
+Writes synthetic schedules in the exact layout ShiftStream expects, used for benchmarks and trying out changes:
+
+    python schedule_generator.py schedules/ --buildings 40 --employees 25 --weeks 2
+
+Every tab covers two weeks: a title row with the building name, then for each week a "Date" header row
+(dates in every other column starting at column C, total hours in column Q and the hourly rate in column R),
+a "Day" row and one row per employee with time in / time out pairs next to each other.
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta, time
+
+from openpyxl import Workbook
+
+FIRST_NAMES = ["Maria", "James", "Ana", "Luis", "Sarah", "David", "Carmen", "Jose", "Linda", "Kevin",
+               "Rosa", "Daniel", "Grace", "Omar", "Lucia", "Brian", "Elena", "Hector", "Nancy", "Victor"]
+LAST_NAMES = ["Garcia", "Smith", "Lopez", "Nguyen", "Johnson", "Martinez", "Brown", "Hernandez", "Lee", "Davis",
+              "Gonzalez", "Wilson", "Perez", "Clark", "Ramirez", "Lewis", "Torres", "Young", "Flores", "Hall"]
+BUILDING_TYPES = ["Employees", "Valet", "Rover"]
+
+#columns (1 based) used by the layout
+NAME_COLUMN = 2
+FIRST_DAY_COLUMN = 3
+TOTAL_HOURS_COLUMN = 17
+HOURLY_RATE_COLUMN = 18
+
+
+def period_name(start):
+    """ Name of the tab for the two weeks starting at start, for ex. "1-16 to 1-29" """
+    end = start + timedelta(days=13)
+    return "{}-{} to {}-{}".format(start.month, start.day, end.month, end.day)
+
+
+def employee_names(count, rng):
+    """ Unique "first last" names, some with a trailing space like the real schedules """
+    names = set()
+    while len(names) < count:
+        name = "{} {}".format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+        if name in names:
+            name = "{} {}{}".format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), len(names))
+        names.add(name)
+    return [name + " " if rng.random() < 0.1 else name for name in sorted(names)]
+
+
+def _week_rows(start, employees, rates, rng):
+    """ Rows of one week: the Date header, the Day row, one row per employee and two blank rows """
+    width = HOURLY_RATE_COLUMN
+    header = [None] * width
+    header[NAME_COLUMN - 1] = "Date"
+    days = [None] * width
+    days[NAME_COLUMN - 1] = "Day"
+    for day in range(7):
+        date = start + timedelta(days=day)
+        header[FIRST_DAY_COLUMN - 1 + 2 * day] = date
+        days[FIRST_DAY_COLUMN - 1 + 2 * day] = date.strftime("%A")
+    header[TOTAL_HOURS_COLUMN - 1] = "Total hours"
+    header[HOURLY_RATE_COLUMN - 1] = "Hourly Rate"
+    rows = [header, days]
+
+    for name in employees:
+        row = [None] * width
+        row[NAME_COLUMN - 1] = name
+        total = 0
+        for day in range(7):
+            if rng.random() < 0.35:
+                continue
+            start_minutes = rng.randrange(5 * 60, 23 * 60, 15)
+            length = rng.choice([4, 6, 8, 8, 8, 10, 12]) * 60 + rng.choice([0, 0, 30])
+            end_minutes = (start_minutes + length) % (24 * 60)
+            row[FIRST_DAY_COLUMN - 1 + 2 * day] = time(start_minutes // 60, start_minutes % 60)
+            row[FIRST_DAY_COLUMN + 2 * day] = time(end_minutes // 60, end_minutes % 60)
+            total += length / 60
+        row[TOTAL_HOURS_COLUMN - 1] = total
+        row[HOURLY_RATE_COLUMN - 1] = rates[name]
+        rows.append(row)
+
+    return rows + [[], []]
+
+
+def write_schedule(path, building_name, employees, weeks=2, first_day=datetime(2023, 1, 16), seed=0):
+    """
+    Writes one building's schedule workbook
+
+    parameters:
+    path: where to save the xlsx file
+    building_name: name shown in the title row, for ex. "Hamilton Cove Employees"
+    employees: number of employees on the schedule
+    weeks: number of weeks covered, every two weeks go in their own tab
+    first_day: monday the first tab starts on
+    seed: seed of the random generator so the same arguments always write the same file
+
+    returns:
+    the list of tab names written
+
+    """
+    rng = random.Random(seed)
+    names = employee_names(employees, rng)
+    rates = {name: rng.choice([16.5, 17, 17.5, 18, 19, 20, 22.5]) for name in names}
+
+    #write-only mode streams the rows to disk, which keeps big schedules fast to generate
+    workbook = Workbook(write_only=True)
+    tabs = []
+    for period in range((weeks + 1) // 2):
+        start = first_day + timedelta(days=14 * period)
+        worksheet = workbook.create_sheet(period_name(start))
+        tabs.append(worksheet.title)
+
+        worksheet.append([])
+        worksheet.append([None, "{} Weekly Schedule".format(building_name)])
+        worksheet.append([])
+        for week in range(2):
+            for row in _week_rows(start + timedelta(days=7 * week), names, rates, rng):
+                worksheet.append(row)
+
+    workbook.save(path)
+    return tabs
+
+
+def generate_pay_period(directory, buildings=40, employees=25, weeks=2, seed=0):
+    """
+    Writes one schedule workbook per building in directory
+
+    returns:
+    the list of file paths written
+
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number in range(buildings):
+        building_name = "Building {} {}".format(number + 1, BUILDING_TYPES[number % len(BUILDING_TYPES)])
+        path = os.path.join(directory, "schedule_{:04d}.xlsx".format(number + 1))
+        write_schedule(path, building_name, employees, weeks=weeks, seed=seed + number)
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Writes synthetic schedule workbooks in the layout the payroll bot reads")
+    parser.add_argument("directory", help="folder the workbooks are written to")
+    parser.add_argument("--buildings", type=int, default=40, help="number of workbooks, one per building (default: 40)")
+    parser.add_argument("--employees", type=int, default=25, help="employees per building (default: 25)")
+    parser.add_argument("--weeks", type=int, default=2, help="weeks per workbook, two weeks per tab (default: 2)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random generator (default: 0)")
+    args = parser.parse_args(argv)
+
+    paths = generate_pay_period(args.directory, args.buildings, args.employees, args.weeks, args.seed)
+    print("Wrote {} workbooks to {}".format(len(paths), args.directory))
+
+
+if __name__ == "__main__":
+    main()
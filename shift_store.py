@@ -0,0 +1,226 @@
+"""
+Local history of every pay period that has been processed, kept in an embedded SQLite database.
+
+Each period is written once (normalized shifts, hourly rates and the pay lines of payroll_lines), so month-over-month
+and year-to-date views are answered with indexed queries instead of re-reading the excel files. Loading a period
+again replaces only that period.
+"""
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+import pandas as pd
+
+import helper_functions as x
+from payroll_engine import RateTable, clean_building_names
+
+#where the history is kept, can be changed with the PAYROLL_STORE environment variable
+DEFAULT_STORE_PATH = os.environ.get("PAYROLL_STORE", "payroll_history.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS periods (
+    period TEXT PRIMARY KEY,
+    sheet_name TEXT,
+    first_date TEXT,
+    last_date TEXT,
+    loaded_at TEXT
+);
+CREATE TABLE IF NOT EXISTS shifts (
+    period TEXT, building TEXT, employee TEXT, date TEXT,
+    time_in INTEGER, time_out INTEGER, hours REAL, holiday INTEGER,
+    week INTEGER, year INTEGER, month INTEGER
+);
+CREATE TABLE IF NOT EXISTS rates (
+    period TEXT, employee TEXT, hourly_rate REAL
+);
+CREATE TABLE IF NOT EXISTS payroll (
+    period TEXT, employee TEXT, building TEXT, year INTEGER, month INTEGER,
+    holiday_hours REAL, regular_hours REAL, overtime_hours REAL, hourly_rate REAL,
+    regular_pay REAL, overtime_pay REAL, holiday_pay REAL, total_pay REAL,
+    double_time_hours REAL DEFAULT 0, double_time_pay REAL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS shifts_period ON shifts (period);
+CREATE INDEX IF NOT EXISTS shifts_year_month_building ON shifts (year, month, building);
+CREATE INDEX IF NOT EXISTS shifts_employee ON shifts (employee, year, month);
+CREATE INDEX IF NOT EXISTS rates_period ON rates (period);
+CREATE INDEX IF NOT EXISTS payroll_period ON payroll (period);
+CREATE INDEX IF NOT EXISTS payroll_year_month_building ON payroll (year, month, building);
+CREATE INDEX IF NOT EXISTS payroll_employee ON payroll (employee, year, month);
+"""
+
+#columns added to the payroll table after it was first released, histories created before them get them on open
+PAYROLL_ADDED_COLUMNS = {"double_time_hours": "REAL DEFAULT 0", "double_time_pay": "REAL DEFAULT 0"}
+
+
+def period_label(sheet_name, shifts):
+    """ Tab names repeat every year, so a period is named after its tab and the year it starts in, for ex. "2023 1-16 to 1-29" """
+    return "{} {}".format(pd.to_datetime(shifts['Date']).min().year, sheet_name)
+
+
+class ShiftStore:
+    """ Reads and writes the pay period history
+
+    parameters:
+    path: SQLite file, created with its tables and indexes the first time it is used
+
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        with closing(self._connect()) as connection:
+            connection.executescript(SCHEMA)
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(payroll)")}
+            with connection:
+                for column, definition in PAYROLL_ADDED_COLUMNS.items():
+                    if column not in columns:
+                        connection.execute("ALTER TABLE payroll ADD COLUMN {} {}".format(column, definition))
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    def append_period(self, period, sheet_name, shifts, hourly_rates_df, payroll_df):
+        """
+        Writes one pay period, replacing it if it was loaded before
+
+        parameters:
+        period: name of the period, see period_label
+        sheet_name: name of the tab the period was read from
+        shifts: enriched shifts (see enrich_shifts)
+        hourly_rates_df: hourly rate of each employee indexed by employee name, or a RateTable
+        payroll_df: pay lines of the period (see payroll_lines)
+
+        """
+        hourly_rates_df = RateTable.of(hourly_rates_df).to_frame()
+        shift_rows = pd.DataFrame({
+            'period': period,
+            'building': shifts['Building Name'].astype(str).values,
+            'employee': shifts['Employee Name'].astype(str).str.strip().values,
+            'date': shifts['Date'].dt.strftime('%Y-%m-%d').values,
+            'time_in': x.minutes_since_midnight(shifts['Time In']).values,
+            'time_out': x.minutes_since_midnight(shifts['Time Out']).values,
+            'hours': shifts['Hours Worked'].values,
+            'holiday': shifts['holiday'].values,
+            'week': shifts['Week of year'].values,
+            'year': shifts['Year'].values,
+            'month': shifts['Month'].values,
+        })
+        rate_rows = pd.DataFrame({
+            'period': period,
+            'employee': hourly_rates_df.index.astype(str),
+            'hourly_rate': hourly_rates_df['Hourly Rate'].values,
+        })
+        payroll_rows = pd.DataFrame({
+            'period': period,
+            'employee': payroll_df['Employee Name'].astype(str).values,
+            'building': payroll_df['Building Name'].astype(str).values,
+            'year': payroll_df['Year'].astype(int).values,
+            'month': payroll_df['Month'].astype(int).values,
+            'holiday_hours': payroll_df['Holiday Hours'].values,
+            'regular_hours': payroll_df['Regular Hours'].values,
+            'overtime_hours': payroll_df['Overtime Hours'].values,
+            'hourly_rate': payroll_df['Hourly Rate'].values,
+            'regular_pay': payroll_df['Regular Hours Pay'].values,
+            'overtime_pay': payroll_df['Overtime Pay'].values,
+            'holiday_pay': payroll_df['Holiday Pay'].values,
+            'total_pay': payroll_df['Total Pay'].values,
+            'double_time_hours': payroll_df['Double Time Hours'].values,
+            'double_time_pay': payroll_df['Double Time Pay'].values,
+        })
+
+        with closing(self._connect()) as connection:
+            #one transaction, a period is either fully replaced or left as it was
+            with connection:
+                for table in ("shifts", "rates", "payroll", "periods"):
+                    connection.execute("DELETE FROM {} WHERE period = ?".format(table), (period,))
+                shift_rows.to_sql("shifts", connection, if_exists="append", index=False)
+                rate_rows.to_sql("rates", connection, if_exists="append", index=False)
+                payroll_rows.to_sql("payroll", connection, if_exists="append", index=False)
+                connection.execute("INSERT INTO periods VALUES (?, ?, ?, ?, ?)", (
+                    period, sheet_name, shift_rows['date'].min(), shift_rows['date'].max(),
+                    datetime.now().isoformat(timespec="seconds")))
+
+    def save_periods(self, shifts, hourly_rates_df, multipliers=None, rules=None):
+        """
+        Writes every pay period of the shifts (one per value of their Pay Period column), returns the names of the periods saved
+
+        parameters:
+        shifts: enriched shifts of one or more tabs (see enrich_shifts and ingest_workbooks)
+        hourly_rates_df: hourly rate of each employee indexed by employee name, or a RateTable
+        multipliers: optional pay multipliers (see payroll_lines)
+        rules: optional pay rules (see payroll_lines)
+
+        """
+        #one rate table for every period
+        hourly_rates_df = RateTable.of(hourly_rates_df)
+        saved = []
+        for sheet_name, period_shifts in shifts.groupby('Pay Period', sort=False, observed=True):
+            period = period_label(sheet_name, period_shifts)
+            payroll_df = x.payroll_lines(period_shifts.copy(), hourly_rates_df, multipliers=multipliers, rules=rules)
+            self.append_period(period, sheet_name, period_shifts, hourly_rates_df, payroll_df)
+            saved.append(period)
+        return saved
+
+    def periods(self):
+        """ Every period in the history with its first and last day and number of shifts """
+        return self._query("""
+            SELECT p.period AS "Period", p.sheet_name AS "Tab", p.first_date AS "First Day", p.last_date AS "Last Day",
+                   (SELECT COUNT(*) FROM shifts s WHERE s.period = p.period) AS "Shifts", p.loaded_at AS "Loaded At"
+            FROM periods p ORDER BY p.first_date
+        """)
+
+    def payroll_by_building(self, year=None):
+        """ $ spent by building and month across every stored period, optionally for one year """
+        df = self._query("""
+            SELECT building AS "Building Name", month AS "Month", year AS "Year",
+                   SUM(total_pay) AS "Total Pay", SUM(overtime_pay) AS "Overtime Pay",
+                   SUM(regular_pay) AS "Regular Hours Pay", SUM(holiday_pay) AS "Holiday Pay",
+                   SUM(double_time_pay) AS "Double Time Pay"
+            FROM payroll {}
+            GROUP BY building, year, month
+        """.format(self._year_filter(year)), self._year_params(year))
+        #the same building can come from its Employees, Rover and Valet schedules, combine them once the names are cleaned
+        df['Building Name'] = clean_building_names(df['Building Name'])
+        df = df.groupby(['Building Name', 'Year', 'Month'], as_index=False).sum()
+        return df.sort_values(['Year', 'Month', 'Building Name']).reset_index(drop=True)
+
+    def hours_by_employee(self, year=None, month=None):
+        """ Holiday, regular, overtime and double time hours of each employee across every stored period, optionally for one year or month """
+        conditions = []
+        params = []
+        if year is not None:
+            conditions.append("year = ?")
+            params.append(int(year))
+        if month is not None:
+            conditions.append("month = ?")
+            params.append(int(month))
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        return self._query("""
+            SELECT employee AS "Employee Name", SUM(holiday_hours) AS "Holiday Hours",
+                   SUM(regular_hours) AS "Regular Hours", SUM(overtime_hours) AS "Overtime Hours",
+                   SUM(double_time_hours) AS "Double Time Hours",
+                   SUM(total_pay) AS "Total Pay"
+            FROM payroll {}
+            GROUP BY employee ORDER BY employee
+        """.format(where), params)
+
+    def hours_by_building_month(self, year=None):
+        """ Hours worked by building and month, straight from the stored shifts """
+        df = self._query("""
+            SELECT building AS "Building Name", year AS "Year", month AS "Month", SUM(hours) AS "Hours Worked"
+            FROM shifts {}
+            GROUP BY building, year, month
+        """.format(self._year_filter(year)), self._year_params(year))
+        df['Building Name'] = clean_building_names(df['Building Name'])
+        df = df.groupby(['Building Name', 'Year', 'Month'], as_index=False).sum()
+        return df.sort_values(['Year', 'Month', 'Building Name']).reset_index(drop=True)
+
+    def _year_filter(self, year):
+        return "WHERE year = ?" if year is not None else ""
+
+    def _year_params(self, year):
+        return [int(year)] if year is not None else []
+
+    def _query(self, sql, params=()):
+        with closing(self._connect()) as connection:
+            return pd.read_sql_query(sql, connection, params=params)
@@ -4,6 +4,12 @@ import streamlit as st
 from datetime import datetime, timedelta, time
 import re
 import helper_functions as x
+from pipeline_trace import PipelineTrace, NULL_TRACE
+from shift_store import ShiftStore
+from payroll_engine import PAY_MULTIPLIERS
+from pay_rules import PayRules
+from report_export import FORMATS, REPORTS, export_key, export_report
+from payroll_cube import IncrementalCube, employee_hours, filter_cube, hours_by_building, payroll_by_building
 import altair as alt
 import plotly.express as px
 
@@ -20,15 +26,47 @@ Get ready to take your payroll game to the next level with the Maverick Payroll
 # Streamlit side bar with a logo
 with st.sidebar:
     st.sidebar.image("logo_transparent.png")
+    #keeps the shifts and pay of this period in the local history
+    save_to_history = st.checkbox("💾 Save this period to history", help="Adds the period to the history so month-over-month views don't need the files again")
+    #timings of every step, only recorded when switched on
+    show_diagnostics = st.checkbox("🔎 Show diagnostics", help="Records how long each step takes per file, with row counts and peak memory")
+    #overtime, holiday and double time hours are paid at these multiples of the hourly rate
+    with st.expander("💲 Pay multipliers"):
+        pay_multipliers = {
+            "Overtime Hours": st.number_input("Overtime", min_value=1.0, value=PAY_MULTIPLIERS["Overtime Hours"], step=0.25),
+            "Holiday Hours": st.number_input("Holiday", min_value=1.0, value=PAY_MULTIPLIERS["Holiday Hours"], step=0.25),
+            "Double Time Hours": st.number_input("Double time", min_value=1.0, value=PAY_MULTIPLIERS["Double Time Hours"], step=0.25),
+        }
+    #which hours are overtime or double time, overtime past 40 regular hours a week unless a rules file says otherwise
+    with st.expander("⏱️ Overtime rules"):
+        rules_file = st.file_uploader("Pay rules (json)", type="json", help="Weekly and daily overtime and double time thresholds, per building if needed")
+        pay_rules = PayRules()
+        if rules_file is not None:
+            try:
+                pay_rules = PayRules.load(rules_file)
+            except ValueError as error:
+                st.error("Could not read the pay rules, the default ones are used: {}".format(error))
+        st.json(pay_rules.to_dict())
+
+@st.experimental_singleton
+def get_workbook_cache():
+    #one cache of parsed workbooks shared by every session, it survives reruns so unchanged files aren't parsed again
+    return x.WorkbookCache()
+
+@st.experimental_singleton
+def get_worker_pool():
+    #one pool of processes shared by every session, it keeps a core free so the app answers other users during a long run
+    return x.WorkerPool()
+
+@st.experimental_singleton
+def get_shift_store():
+    #history of every saved pay period
+    return ShiftStore()
 
 # List of holiday dates provided by Matt
-holidays = ['2023-11-23', '2023-11-25', '2023-12-31', '2023-07-04', '2023-05-29', '2023-09-04']
-#list holds cleaned files from first week work schedules, used in for loop 
-df_list = [] 
-#list holds cleaned files from second week work schedules
-df_list_week_two = []
-#list holds hourly pay rates for each employee, average of first and second week pay rate
-hourly_rates_list = []
+holidays = x.HOLIDAYS
+#records every step of this run when diagnostics are on, does nothing otherwise
+trace = PipelineTrace() if show_diagnostics else NULL_TRACE
 
 
 with st.form(key='my_form'):
@@ -46,6 +84,7 @@ with st.form(key='my_form'):
     st.write("                                                       ")
     st.subheader("2- Provide the name of the tab in your excel file")
     sheet_name = st.text_input("📄 example: 1-16 to 1-29", help="Make sure it matches exactly your tab name in the excel file")
+    all_tabs = st.checkbox("📚 Use every pay-period tab instead (for ex. to catch up on a whole quarter)", help="Reads every tab named like 1-16 to 1-29 from each file in one go, the tab name above is ignored")
       
     st.write("""                                                                         """)
     st.subheader("3-Submit")
@@ -54,112 +93,200 @@ with st.form(key='my_form'):
     #if files are uploaded, clean them and save them in a list  
     if submit_button:
 
+        #results of the files that were parsed, the cube of the session is brought up to date with them
+        results = []
+
+        #files are told apart by name, two uploads with the same name (from different folders) can't both be loaded
+        name_counts = pd.Series([file.name for file in files_names], dtype=object).value_counts()
+        upload_files = []
+        for file in files_names:
+            if name_counts[file.name] > 1:
+                st.error("Could not process {}: another uploaded file has the same name, rename one of them and submit again".format(file.name))
+            else:
+                upload_files.append(file)
+        #hours worked by building so far, shown while the other files are still being parsed
+        running_hours = []
+
+        #progress of the run, filled in as each file finishes
+        progress_bar = st.progress(0)
+        progress_text = st.empty()
+        running_totals = st.empty()
+        started = datetime.now()
+        done = 0
+
         # for each file in the files uploaded (bi-weekly schedules)
             #clean file in a suitable format for further analysis
             #save each file in a list
-        for file in files_names: 
+        #files are parsed on the shared pool, results come back as each file finishes, files that didn't change come straight from the cache
+        #the run happens on a background thread, this one only updates the page
+        ingest = x.ingest_workbooks(upload_files, None if all_tabs else sheet_name, cache=get_workbook_cache(), trace=trace, holidays=holidays, pool=get_worker_pool())
+        for result in x.in_background(ingest):
+            progress_text.caption("{} of {} files done, {:.0f}s elapsed".format(done, len(upload_files), (datetime.now() - started).total_seconds()))
 
-            #cleans xlsx file in a format that helps in calculating hours worked by employee
-   
-            transformed_file = x.transform_schedule(file, sheet_name=sheet_name) 
-            transformed_file_week2 = x.transform_schedule_week2(file, sheet_name=sheet_name)
-            hourly_rates_function = x.extract_hourly_rates(file, sheet_name=sheet_name)
-            
-
-            #returns the building name associated w each xlsx file
-            building_name = x.get_building_name(file, sheet_name) 
-            # adds building name to both weeks
-            transformed_file['Building Name'] = building_name 
-            transformed_file_week2['Building Name'] = building_name
-
-            #saves cleaned file in a list
-            df_list.append(transformed_file)
-            df_list_week_two.append(transformed_file_week2)
-            hourly_rates_list.append(hourly_rates_function)
+            #nothing finished yet, only the elapsed time moves
+            if result is None:
+                continue
+            done += 1
+            progress_bar.progress(done / len(upload_files))
+
+            #a broken file is reported by name, the rest of the batch keeps going
+            if result['error'] is not None:
+                st.error("Could not process {}: {}".format(result['file_name'], result['error']))
+                continue
+
+            #saves cleaned file in a list, each file has both weeks and the building name
+            results.append(result)
 
             #prints success for user! 
-            st.success("Successfully uploaded {}".format(file.name))
+            if result['building_name'] is None:
+                st.warning("Uploaded {}, but its title has no building name, its shifts are listed under {}".format(
+                    result['file_name'], x.UNKNOWN_BUILDING.format(result['file_name'])))
+            else:
+                st.success("Successfully uploaded {}".format(result['file_name']))
+
+            running_hours.append(x.hours_by_building(result['shifts']).assign(**{'Building Name': lambda df: df['Building Name'].astype(str)}))
+            running_df = pd.concat(running_hours).groupby('Building Name', as_index=False)['Hours Worked'].sum()
+            running_totals.dataframe(running_df.sort_values(by="Hours Worked", ascending=False), width=1000)
+
+        progress_text.caption("{} of {} files done in {:.0f}s".format(done, len(upload_files), (datetime.now() - started).total_seconds()))
+
+        if len(results) > 0:
+            #only the employee-weeks of the files that were added, replaced or removed since the last submit are recalculated
+            incremental_cube = st.session_state.setdefault('incremental_cube', IncrementalCube(pay_multipliers, rules=pay_rules))
+            incremental_cube.update(results, trace=trace)
+            df = incremental_cube.shifts
+            #name of the period(s) shown in the captions
+            if all_tabs:
+                sheet_name = ", ".join(df['Pay Period'].unique())
+            #the data stays in the session, so filters and downloads don't need the files to be submitted again
+            st.session_state['dataset'] = {
+                "version": incremental_cube.version,
+                "shifts": df,
+                #the table of employee hourly $ rates is built once (one rate per employee), it is used to calculate the tot. cost per employee
+                "hourly_rates": incremental_cube.rate_table,
+                "sheet_name": sheet_name,
+            }
+            if save_to_history:
+                saved_periods = get_shift_store().save_periods(df, st.session_state['dataset']['hourly_rates'], multipliers=pay_multipliers, rules=pay_rules)
+                st.success("Saved {} to the history".format(", ".join(saved_periods)))
+        else:
+            #the tables and downloads of the previous submit would look like the results of this one
+            st.session_state.pop('dataset', None)
+            st.session_state.pop('incremental_cube', None)
+            st.warning("None of the files could be processed, the results of the previous submit were cleared.")
         
     else:
         #avoids printing error to user, instead says no file uploaded
         st.caption(" No files uploaded")
 
-try: 
-
-    #combines cleaned xlsx files from each building into one dataframe called "df"
-    df_week_one = pd.concat(df_list, axis=0) 
-    df_week_two = pd.concat(df_list_week_two, axis=0)
-    df = pd.concat([df_week_one, df_week_two], axis=0)
+#labels of the download buttons of each format
+FORMAT_LABELS = {"csv": "CSV", "xlsx": "Excel", "parquet": "Parquet"}
 
-    #Builds a dataframe for employee hourly $ rates, will be used later to calculate the tot. cost per employee
-    hourly_rates_df = pd.concat(hourly_rates_list, axis=0)
+@st.experimental_memo(max_entries=16)
+def get_exports(report, key, _df, _hourly_rates=None):
+    #every format of a report is written once per input (see export_key), reruns download the stored bytes
+    return export_report(report, _df, hourly_rates=_hourly_rates)
 
+def download_buttons(report, exports):
+    #one button per format, side by side
+    for column, (name, data) in zip(st.columns(len(exports)), exports.items()):
+        mime, extension = FORMATS[name]
+        column.download_button(
+            label=":arrow_down: {}".format(FORMAT_LABELS[name]),
+            data=data,
+            file_name=REPORTS[report]["file_name"] + extension,
+            mime=mime,
+            key="{}-{}".format(report, name),)
 
-    # Adds important columns to be used in next steps
-    df['holiday'] = df['Date'].apply(lambda x: 1 if x.date().isoformat() in holidays else 0) 
-    df['Date'] = pd.to_datetime(df['Date']) 
-    df['Week of year'] = df['Date'].apply(lambda x: x.isocalendar()[1])
-    df['Year'] = df['Date'].apply(lambda x: x.year)
-    df['Month'] = df['Date'].apply(lambda x: x.month)
+dataset = st.session_state.get('dataset')
+if dataset is not None: 
 
-    # calculates hours worked by employee by building by week
-    df = x.hours_worked(df) 
+    sheet_name = dataset['sheet_name']
+    #changing the multipliers re-prices the cube, the hours are kept, changing the pay rules builds it again
+    incremental_cube = st.session_state['incremental_cube']
+    incremental_cube.set_rules(pay_rules)
+    incremental_cube.set_multipliers(pay_multipliers)
+    cube = incremental_cube.cube
 
-    # returns a dataframe breaking down tot. hours worked into regular, overtime and holiday hours by employee for each week
-    final_df = x.process_hours(df)
+    #filters only slice the cube, nothing is recalculated from the shifts
+    st.subheader("🔍 Filters")
+    all_buildings = sorted(cube['Building Name'].astype(str).unique().tolist())
+    buildings = st.multiselect("Buildings", all_buildings, default=all_buildings)
+    first_day, last_day = dataset['shifts']['Date'].min().date(), dataset['shifts']['Date'].max().date()
+    date_range = st.date_input("Dates", value=(first_day, last_day), min_value=first_day, max_value=last_day, help="Whole weeks are kept, a week counts if it overlaps the dates")
+    #while picking a range the widget only has its first day
+    start, end = (date_range[0], date_range[-1]) if isinstance(date_range, (list, tuple)) else (date_range, date_range)
+    cube = filter_cube(cube, buildings=buildings, start=start, end=end)
+    #names everything the reports below are made from, their downloads are only written again when it changes
+    report_key = export_key(dataset['version'], pay_multipliers, pay_rules.to_dict(), buildings, start, end)
 
-    # final view! user sees each employee's total holiday, regular and overtime hours
-    grouped_final_view = final_df.groupby("Employee Name").agg({"Holiday Hours":"sum", "Regular Hours":"sum", "Overtime Hours":"sum"})
-    grouped_final_view = grouped_final_view.reset_index(drop=False)
-    grouped_final_view['Employee Name'] = x.find_employee_names(grouped_final_view)
-    st.dataframe(grouped_final_view.style.format({'Holiday Hours': '{:,.1f}', 'Regular Hours': '{:,.1f}', 'Overtime Hours': '{:,.1f}'}), width=1000) #render result on streamlit 
+    # final view! user sees each employee's total holiday, regular and overtime hours (overtime is counted week by week)
+    #names are kept as written for the PayChex rates, "last first" is only for showing them
+    employee_hours_df = employee_hours(cube, rules=pay_rules, show_names=False)
+    grouped_final_view = employee_hours_df.assign(**{'Employee Name': x.find_employee_names(employee_hours_df)})
+    st.dataframe(grouped_final_view.style.format({'Holiday Hours': '{:,.1f}', 'Regular Hours': '{:,.1f}', 'Overtime Hours': '{:,.1f}', 'Double Time Hours': '{:,.1f}'}), width=1000) #render result on streamlit 
 
-    #download to csv
-    prcs_csv = x.convert_df(grouped_final_view)
-    st.download_button(
-        label=":arrow_down: Download to excel",
-        data=prcs_csv,
-        file_name='auto-report.csv',
-        mime='text/csv',)
+    #downloads, also in the PayChex import layout
+    download_buttons("employee_hours", get_exports("employee_hours", report_key, grouped_final_view))
+    st.caption("PayChex import")
+    download_buttons("paychex", get_exports("paychex", report_key, employee_hours_df, dataset['hourly_rates']))
    
 
     #plotly chart visualizes hours worked by each building
     st.write("                                      ")
     st.title("📊 Summary of hours worked by building")
     st.caption("The bar chart below summarizes the number of hours worked in each building during the period {}".format(sheet_name))
-    visual_df = df.groupby(["Building Name"]).agg({"Hours Worked":"sum"}).reset_index().sort_values(by="Hours Worked", ascending=True)
+    visual_df = hours_by_building(cube)
     fig = px.bar(visual_df, x='Hours Worked', y='Building Name')
     st.plotly_chart(fig, use_container_width=True)
 
 
-    # calculates payroll in $ by building, accounts for overtime/holiday as 1.5x
+    # calculates payroll in $ by building, overtime/holiday are paid at the multipliers set in the sidebar
     st.write("                                     ")
     st.title("💵 Summary of payroll by building in $")
-    st.caption("The data below shows the $ spent by building on employees, broken down by Regular, OT and Holiday hours for the period {}".format(sheet_name))
-    df = x.process_hours_version_2(df)
-    df = df.join(hourly_rates_df, on="Employee Name", how="left")
-    df['Regular Hours Pay'] = df['Regular Hours'] * df['Hourly Rate']
-    df['Overtime Pay'] = df['Overtime Hours'] * (df['Hourly Rate'] * 1.5)
-    df['Holiday Pay'] = df['Holiday Hours'] * (df['Hourly Rate'] * 1.5)
-    df['Total Pay'] = df['Overtime Pay'] + df['Holiday Pay'] + df['Regular Hours Pay']
-    df = df.groupby(['Building Name', 'Month', 'Year']).agg({"Total Pay":"sum", "Overtime Pay":"sum", "Regular Hours Pay":"sum", "Holiday Pay":"sum"})
-    df = df.reset_index()
-    df['Year'] = df['Year'].astype("str")
-    df['Building Name'] = df['Building Name'].str.replace('Employees', '').str.replace('Rover', '').str.replace('Valet','').str.strip()
+    st.caption("The data below shows the $ spent by building on employees, broken down by Regular, OT, Double time and Holiday hours for the period {}".format(sheet_name))
+    df = payroll_by_building(cube)
     st.dataframe(df, width=1000)
 
-    #download to csv
-    cost_csv = df.to_csv().encode('utf-8')
-    st.download_button(
-        label=":arrow_down: Download to excel",
-        data=cost_csv,
-        file_name='payroll_by_building.csv',
-        mime='text/csv',)
+    #downloads
+    download_buttons("payroll_by_building", get_exports("payroll_by_building", report_key, df))
 
-except:
+    #the shifts every table above is calculated from, the same whatever the filters
+    with st.expander("🗂️ Normalized shifts"):
+        download_buttons("shifts", get_exports("shifts", dataset['version'], dataset['shifts']))
+
+else:
     #if no file uploaded, prints error message
     st.warning("Please upload a file before proceeding.")
 
+#history of the saved pay periods, answered from the local store without the excel files
+history_periods = get_shift_store().periods()
+if len(history_periods) > 0:
+    st.write("                                     ")
+    st.title("📚 History")
+    st.caption("Pay periods saved so far, {} in total".format(len(history_periods)))
+    with st.expander("Saved pay periods"):
+        st.dataframe(history_periods, width=1000)
+    history_years = sorted(get_shift_store().hours_by_building_month()['Year'].unique().tolist())
+    history_year = st.selectbox("Year", ["All years"] + history_years)
+    history_year = None if history_year == "All years" else history_year
+    st.subheader("Payroll by building and month")
+    st.dataframe(get_shift_store().payroll_by_building(year=history_year), width=1000)
+    st.subheader("Hours by employee")
+    st.dataframe(get_shift_store().hours_by_employee(year=history_year), width=1000)
+
+#diagnostics panel, time spent by each step and each file of this run
+if trace.enabled and trace.records:
+    with st.expander("🔎 Diagnostics"):
+        trace_df = trace.to_frame()
+        st.caption("Total time {:,.2f}s over {} steps".format(trace_df['seconds'].sum(), len(trace_df)))
+        st.dataframe(trace_df.style.format({'seconds': '{:,.3f}', 'peak_memory_mb': '{:,.1f}'}, na_rep=""), width=1000)
+        st.download_button(
+            label=":arrow_down: Download trace",
+            data=trace.to_json(),
+            file_name='payroll-trace.json',
+            mime='application/json',)
+
 
 
 